@@ -0,0 +1,78 @@
+import argparse
+import time
+import json
+import os
+import torch
+from transformers import T5TokenizerFast
+
+from question_answering import T5_Question_Answering
+from inference_backend import INFERENCE_BACKENDS, get_inference_backend
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    # dataset args
+    parser.add_argument('--dataset_name', default='HOVER', type=str)
+    parser.add_argument('--FV_data_path', type=str)
+    parser.add_argument('--setting', default='close-book', help='[gold | close-book]', type=str)
+    parser.add_argument('--num_eval_samples', default=200, type=int)
+    # model args
+    parser.add_argument("--model_name", default = 'google/flan-t5-xl', type=str)
+    parser.add_argument("--cache_dir", type=str)
+    parser.add_argument('--backends', default='cpu_fp32,cpu_int8,cpu_bf16', help='comma-separated backends, compared to cpu_fp32', type=str)
+    parser.add_argument('--qa_batch_size', default=16, type=int)
+    parser.add_argument('--max_batch_tokens', default=16384, type=int)
+    parser.add_argument('--num_threads', default=None, help='number of torch CPU threads', type=int)
+    args = parser.parse_args()
+    return args
+
+def load_verify_prompts(args, QA_module):
+    with open(os.path.join(args.FV_data_path, args.dataset_name, 'claims', 'dev.json'), 'r') as f:
+        dataset = json.load(f)
+    dataset = dataset if args.num_eval_samples < 0 else dataset[:args.num_eval_samples]
+    claim_only = True if args.setting == 'close-book' else False
+    prompts = [QA_module.verify_prompt(sample['claim'], sample.get('evidence'), claim_only) for sample in dataset]
+    return [template.format(**fields) for template, fields in prompts]
+
+def run_backend(args, backend_name, tokenizer, examples):
+    backend = get_inference_backend(backend_name)
+    start = time.time()
+    model = backend.load_model(args.model_name, cache_dir = args.cache_dir)
+    load_time = time.time() - start
+
+    QA_module = T5_Question_Answering(model, tokenizer, args.model_name, device = backend.device)
+    start = time.time()
+    answers = QA_module.generate_many(examples, args.max_batch_tokens, args.qa_batch_size,
+                                      max_length = None, max_new_tokens = 8)
+    run_time = time.time() - start
+    answers = [answer.strip() for answer in answers]
+    # count the generated tokens, including the end of sequence token
+    num_tokens = sum([len(ids) for ids in tokenizer(answers)['input_ids']])
+    return answers, load_time, run_time, num_tokens
+
+def main():
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    tokenizer = T5TokenizerFast.from_pretrained(args.model_name, cache_dir = args.cache_dir)
+    examples = load_verify_prompts(args, T5_Question_Answering(None, tokenizer))
+    print(f"Benchmarking {len(examples)} Verify prompts ({args.setting}) with {args.model_name}.")
+
+    backends = [name.strip() for name in args.backends.split(',')]
+    for name in backends:
+        if name not in INFERENCE_BACKENDS:
+            raise NotImplementedError(f"Unknown inference backend: {name}")
+    if 'cpu_fp32' in backends:
+        backends.remove('cpu_fp32')
+    backends = ['cpu_fp32'] + backends
+
+    baseline_answers = None
+    print(f"{'backend':<15}{'load (s)':>10}{'run (s)':>10}{'tokens/s':>10}{'prompts/s':>11}{'agreement':>11}")
+    for name in backends:
+        answers, load_time, run_time, num_tokens = run_backend(args, name, tokenizer, examples)
+        if baseline_answers is None:
+            baseline_answers = answers
+        agreement = sum([answer.lower() == baseline.lower() for answer, baseline in zip(answers, baseline_answers)]) / len(answers)
+        print(f"{name:<15}{load_time:>10.1f}{run_time:>10.1f}{num_tokens / run_time:>10.1f}{len(answers) / run_time:>11.2f}{agreement:>11.2%}")
+
+if __name__ == "__main__":
+    main()
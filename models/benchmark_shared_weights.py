@@ -0,0 +1,84 @@
+import argparse
+import multiprocessing
+import time
+import torch
+from transformers import T5TokenizerFast
+
+from inference_backend import INFERENCE_BACKENDS, get_inference_backend
+
+# Starts N worker processes that each load the sub-task model, as the shards of
+# launch_shards.py do, and reports their startup time and memory. RSS counts
+# shared pages in every process; PSS splits them between the processes sharing
+# them, so the sum of PSS is the memory the workers really use together.
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", default = 'google/flan-t5-xl', type=str)
+    parser.add_argument("--cache_dir", type=str)
+    parser.add_argument('--backends', default='cpu_fp32,cpu_shared', help='comma-separated CPU backends to compare', type=str)
+    parser.add_argument('--num_workers', default='1,4,8', help='comma-separated numbers of worker processes', type=str)
+    parser.add_argument('--threads_per_worker', default=1, type=int)
+    args = parser.parse_args()
+    return args
+
+def read_memory():
+    """RSS and PSS of this process in bytes, from /proc (Linux)."""
+    memory = {}
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ['Rss:', 'Pss:']:
+                memory[fields[0][:-1].lower()] = int(fields[1]) * 1024
+    return memory
+
+def worker(args, backend_name, tokenizer, barrier, results):
+    torch.set_num_threads(args.threads_per_worker)
+    start = time.time()
+    model = get_inference_backend(backend_name).load_model(args.model_name, cache_dir = args.cache_dir)
+    load_time = time.time() - start
+    # one generation touches every weight, as the first real batch would
+    inputs = tokenizer(["Is it true that the sky is blue? True or False? The answer is:"], return_tensors = 'pt')
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens = 4)
+    startup_time = time.time() - start
+    # measure while all the workers are alive, so that shared pages are split between them
+    barrier.wait()
+    results.put((load_time, startup_time, read_memory()))
+    barrier.wait()
+
+def run_workers(args, backend_name, tokenizer, num_workers):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(num_workers)
+    results = context.Queue()
+    processes = [context.Process(target = worker, args = (args, backend_name, tokenizer, barrier, results)) for _ in range(num_workers)]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in range(num_workers)]
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise Exception(f"A {backend_name} worker failed with code {process.exitcode}")
+    return measurements
+
+def main():
+    args = parse_args()
+    tokenizer = T5TokenizerFast.from_pretrained(args.model_name, cache_dir = args.cache_dir)
+    backends = [name.strip() for name in args.backends.split(',')]
+    for name in backends:
+        if name not in INFERENCE_BACKENDS or name == 'parallelize':
+            raise NotImplementedError(f"Unknown CPU inference backend: {name}")
+    print(f"Benchmarking worker startup with {args.model_name}.")
+
+    GB = 1024 ** 3
+    print(f"{'backend':<12}{'workers':>8}{'load (s)':>10}{'startup (s)':>13}{'RSS/worker (GB)':>17}{'total PSS (GB)':>16}")
+    for name in backends:
+        for num_workers in [int(n) for n in args.num_workers.split(',')]:
+            measurements = run_workers(args, name, tokenizer, num_workers)
+            load_time = max([load_time for load_time, _, _ in measurements])
+            startup_time = max([startup_time for _, startup_time, _ in measurements])
+            rss = sum([memory['rss'] for _, _, memory in measurements]) / num_workers
+            pss = sum([memory['pss'] for _, _, memory in measurements])
+            print(f"{name:<12}{num_workers:>8}{load_time:>10.1f}{startup_time:>13.1f}{rss / GB:>17.2f}{pss / GB:>16.2f}")
+
+if __name__ == "__main__":
+    main()
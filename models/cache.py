@@ -0,0 +1,83 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+def hash_key(*parts):
+    """Content-addressed key: sha256 of the JSON serialization of `parts`."""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+class Persistent_Cache:
+    """Key-value cache with an in-memory LRU and an optional sqlite backing store.
+
+    Values must be JSON serializable. Without `db_path` the cache only lives
+    in memory. The sqlite database uses WAL mode, so several processes can
+    share one cache file.
+    """
+    def __init__(self, db_path = None, table = 'cache', max_memory_items = 100000) -> None:
+        self.db_path = db_path
+        self.table = table
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+        self.connection = None
+        if db_path is not None:
+            db_dir = os.path.dirname(db_path)
+            if db_dir != '' and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            self.connection = sqlite3.connect(db_path, timeout = 60, check_same_thread = False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.commit()
+
+    def __len__(self):
+        return len(self.memory)
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last = False)
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            if self.connection is not None:
+                row = self.connection.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        """Store a list of (key, value) pairs in a single transaction."""
+        with self.lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.connection is not None:
+                self.connection.executemany(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                                            [(key, json.dumps(value, ensure_ascii=False)) for key, value in items])
+                self.connection.commit()
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.memory)} entries in memory"
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -1,9 +1,13 @@
-from sklearn.metrics import classification_report, confusion_matrix
 import json
+import math
 import argparse
 import os
 
+from io_utils import iter_json_records
+
 def print_evaluation_results(predictions, gt_labels, num_of_classes=3):
+    # sklearn is slow to import and only needed once the predictions are in
+    from sklearn.metrics import classification_report, confusion_matrix
     if num_of_classes == 3:
         target_names = ['refutes', 'supports', 'not enough info']
         label_map = {'refutes': 0, 'supports': 1, 'not enough info': 2}
@@ -21,9 +25,23 @@ def print_evaluation_results(predictions, gt_labels, num_of_classes=3):
         print(confusion_matrix(labels, predictions))
         print()
 
+def percentile(values, q):
+    """The q-th percentile (0-100) of a list of numbers, by nearest rank (None for an empty list)."""
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+def latency_summary(latencies, wall_seconds):
+    """Throughput and latency percentiles of the requests served in `wall_seconds`."""
+    return {'requests': len(latencies), 
+            'throughput': len(latencies) / max(wall_seconds, 1e-9),
+            'latency_p50': percentile(latencies, 50), 
+            'latency_p99': percentile(latencies, 99)}
+
 def evaluate_hover_by_hops(args, result_file):
-    with open(result_file, 'r') as f:
-        results = json.load(f)
+    results = list(iter_json_records(result_file))
 
     with open(os.path.join(args.FV_data_path, args.dataset_name, 'claims', 'dev.json'), 'r') as f:
         dataset = json.load(f)
@@ -43,8 +61,7 @@ def evaluate_hover_by_hops(args, result_file):
         print()
 
 def evaluate_feverous(result_file):
-    with open(result_file, 'r') as f:
-        results = json.load(f)
+    results = list(iter_json_records(result_file))
 
     predictions = []
     gt_labels = []
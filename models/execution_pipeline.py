@@ -0,0 +1,302 @@
+import time
+import queue
+import threading
+
+from execution_state import Program_State, Vote_State
+
+class Stage_Stats:
+    """Busy time and throughput of a pipeline stage run by `num_workers` threads."""
+    def __init__(self, name, num_workers = 1) -> None:
+        self.name = name
+        self.num_workers = num_workers
+        self.busy_seconds = 0.0
+        self.num_items, self.num_batches = 0, 0
+        self.lock = threading.Lock()
+
+    def add(self, busy_seconds, num_items):
+        with self.lock:
+            self.busy_seconds += busy_seconds
+            self.num_items += num_items
+            self.num_batches += 1
+
+    def summary(self, wall_seconds):
+        utilization = self.busy_seconds / max(wall_seconds * self.num_workers, 1e-9)
+        items_per_batch = self.num_items / max(self.num_batches, 1)
+        return f"{self.name}: {utilization:.0%} busy, {self.num_items} items in {self.num_batches} batches ({items_per_batch:.1f} per batch)"
+
+class Sample_Job:
+    """The programs of one sample going through the pipeline (in voting rounds with adaptive voting)."""
+    def __init__(self, sample, evidence, vote) -> None:
+        self.sample = sample
+        self.evidence = evidence
+        self.vote = vote
+        self.entries = []
+        self.states = []
+
+class Execution_Pipeline:
+    """Staged execution of programs with retrieval and inference overlapped.
+
+    The main thread admits samples, walks their dependency graphs and sends
+    ready calls to the retrieval stage (open-book) or directly to the
+    inference stage. Retrieval workers search BM25 for batches of queries
+    while the inference thread answers batches of calls with FLAN-T5; the
+    stages are connected by bounded queues, so a slow stage holds back the
+    ones before it. Answers come back to the main thread, which updates the
+    programs and yields each sample's result as soon as it is done.
+    """
+    def __init__(self, executor, max_samples = 32, queue_size = 256, retrieval_workers = 1,
+                 retrieval_batch_size = 16, inference_batch_size = 64, max_wait = 0.01) -> None:
+        self.executor = executor
+        self.args = executor.args
+        self.max_samples = max_samples
+        self.retrieval_workers = retrieval_workers
+        self.retrieval_batch_size = retrieval_batch_size
+        self.inference_batch_size = inference_batch_size
+        self.max_wait = max_wait
+        self.open_book = self.args.setting == 'open-book'
+        self.claim_only = True if self.args.setting == 'close-book' else False
+
+        self.retrieval_queue = queue.Queue(maxsize = queue_size)
+        self.inference_queue = queue.Queue(maxsize = queue_size)
+        # unbounded, so that the stages can always hand back their answers
+        self.completion_queue = queue.Queue()
+        self.stats = {'retrieval': Stage_Stats('retrieval', retrieval_workers),
+                      'inference': Stage_Stats('inference'),
+                      'bookkeeping': Stage_Stats('bookkeeping')}
+        self.max_queue_sizes = {'retrieval': 0, 'inference': 0}
+
+    def get_batch(self, input_queue, max_items):
+        """Block for one item, then take what arrives within `max_wait`, up to `max_items`."""
+        items = [input_queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(items) < max_items and items[-1] is not None:
+            try:
+                items.append(input_queue.get(timeout = max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return items
+
+    def fail(self, exception, input_queue):
+        """Report the exception to the main thread and keep consuming, so that no stage blocks on a full queue."""
+        self.completion_queue.put(('error', exception))
+        while input_queue.get() is not None:
+            pass
+
+    def isolate_failures(self, calls, run_batch):
+        """Run a batch of calls; when it fails, run them one at a time, so that only the programs
+        of the calls failing again fail. Returns the (call, output) pairs and the failed calls."""
+        try:
+            return list(zip(calls, run_batch(calls))), []
+        except Exception as e:
+            outputs, failed = [], []
+            for call in calls:
+                try:
+                    outputs.append((call, run_batch([call])[0]))
+                except Exception as e:
+                    failed.append(call)
+            return outputs, failed
+
+    def retrieval_worker(self, searcher):
+        try:
+            while True:
+                calls = self.get_batch(self.retrieval_queue, self.retrieval_batch_size)
+                stop = calls[-1] is None
+                calls = [call for call in calls if call is not None]
+                if len(calls) > 0:
+                    start = time.time()
+                    outputs, failed = self.isolate_failures(calls, lambda calls: self.executor.batch_retrieve_evidence(
+                        [argument for _, _, argument, _, _ in calls], searcher))
+                    self.stats['retrieval'].add(time.time() - start, len(calls))
+                    if len(failed) > 0:
+                        self.completion_queue.put(('failed', failed))
+                    for (state, node, argument, _, _), (evidence, retrieved_results) in outputs:
+                        self.put_inference((state, node, argument, evidence, retrieved_results))
+                if stop:
+                    return
+        except Exception as e:
+            self.fail(e, self.retrieval_queue)
+
+    def put_inference(self, call):
+        self.inference_queue.put(call)
+        self.max_queue_sizes['inference'] = max(self.max_queue_sizes['inference'], self.inference_queue.qsize())
+
+    def inference_worker(self):
+        QA_module = self.executor.QA_module
+        try:
+            while True:
+                calls = self.get_batch(self.inference_queue, self.inference_batch_size)
+                stop = calls[-1] is None
+                calls = [call for call in calls if call is not None]
+                if len(calls) > 0:
+                    start = time.time()
+                    verify_calls = [call for call in calls if call[1].c_type == "VERIFY"]
+                    question_calls = [call for call in calls if call[1].c_type == "QUESTION"]
+                    answers, failed = [], []
+                    if len(verify_calls) > 0:
+                        outputs, verify_failed = self.isolate_failures(verify_calls, lambda calls: QA_module.batch_answer_verify_question(
+                            [argument for _, _, argument, _, _ in calls], [evidence for _, _, _, evidence, _ in calls],
+                            self.claim_only, self.args.qa_batch_size, self.args.max_batch_tokens))
+                        answers += [(call, self.executor.map_direct_answer_to_label(output['answer_text']), output.get('probability')) for call, output in outputs]
+                        failed += verify_failed
+                    if len(question_calls) > 0:
+                        outputs, question_failed = self.isolate_failures(question_calls, lambda calls: QA_module.batch_answer_question_directly(
+                            [argument for _, _, argument, _, _ in calls], [evidence for _, _, _, evidence, _ in calls],
+                            self.claim_only, self.args.qa_batch_size, self.args.max_batch_tokens))
+                        answers += [(call, output['answer_text'], None) for call, output in outputs]
+                        failed += question_failed
+                    self.stats['inference'].add(time.time() - start, len(calls))
+                    if len(failed) > 0:
+                        self.completion_queue.put(('failed', failed))
+                    self.completion_queue.put(('answers', answers))
+                if stop:
+                    return
+        except Exception as e:
+            self.fail(e, self.inference_queue)
+
+    def dispatch(self, state):
+        """Send the calls of a program that can run now; returns False when the program is done."""
+        if self.args.lazy_execution and state.graph.can_short_circuit and len(state.pending_nodes) > 0:
+            # lazy execution waits for the answer of the previous call
+            return True
+        try:
+            nodes = [node for node in self.executor.next_nodes(state) if node.index not in state.pending_nodes]
+            arguments = [node.resolve_argument(state.node_values) for node in nodes]
+        except Exception as e:
+            # the answers of its calls still in flight are dropped
+            self.executor.fail_program(state)
+            return False
+        for node, argument in zip(nodes, arguments):
+            state.pending_nodes.add(node.index)
+            self.executor.execution_stats['calls'] += 1
+            if self.open_book:
+                self.retrieval_queue.put((state, node, argument, None, None))
+                self.max_queue_sizes['retrieval'] = max(self.max_queue_sizes['retrieval'], self.retrieval_queue.qsize())
+            else:
+                self.put_inference((state, node, argument, state.evidence, []))
+        return len(state.pending_nodes) > 0
+
+    def start_round(self, job):
+        """Create the program states of the next programs of a sample; returns False when the sample is done."""
+        if job.vote is not None:
+            job.entries = job.vote.next_programs()
+        elif len(job.states) == 0:
+            job.entries = [(program, program_ir, 1) for program, program_ir in
+                           zip(job.sample['predicted_programs'], self.executor.get_program_irs(job.sample))]
+        else:
+            job.entries = []
+        if len(job.entries) == 0:
+            return False
+        job.states = [Program_State(job.sample['id'], program, job.evidence, program_ir) for program, program_ir, _ in job.entries]
+        for state in job.states:
+            state.job = job
+            self.executor.compile_state(state)
+            if not state.finished and not self.dispatch(state):
+                self.executor.finish_program(state)
+        self.executor.execution_stats['executed_programs'] += len(job.entries)
+        return True
+
+    def advance(self, job):
+        """Move a sample whose current programs are all finished to its next round; returns its result when it is done."""
+        while all([state.finished for state in job.states]):
+            if job.vote is not None:
+                job.vote.add_votes(job.entries, [state.final_answer for state in job.states], [state.final_probability for state in job.states])
+            if not self.start_round(job):
+                if job.vote is not None:
+                    final_prediction, probabilities = job.vote.prediction, job.vote.probabilities
+                else:
+                    final_prediction = self.executor.aggregate_predictions([state.final_answer for state in job.states])
+                    probabilities = [state.final_probability for state in job.states]
+                return self.executor.make_result(job.sample, final_prediction, probabilities)
+        return None
+
+    def admit(self, sample):
+        evidence = self.executor.gold_evidence_map[sample['id']] if self.args.setting == 'gold' else None
+        vote = Vote_State(sample['predicted_programs'], self.executor.get_program_irs(sample)) if self.args.adaptive_voting else None
+        self.executor.execution_stats['programs'] += len(sample['predicted_programs'])
+        job = Sample_Job(sample, evidence, vote)
+        return self.advance(job), job
+
+    def complete(self, answers):
+        """Record answers and send the calls they unblock; yields the results of the samples that are done."""
+        for (state, node, _, _, retrieved_results), answer, probability in answers:
+            if state.finished:
+                # the program failed while the call was in flight
+                continue
+            state.node_values[node.index] = answer
+            if probability is not None:
+                state.node_probabilities[node.index] = probability
+            state.retrieved_evidence += retrieved_results
+            state.pending_nodes.discard(node.index)
+            if not self.dispatch(state):
+                self.executor.finish_program(state)
+                yield from self.advance_job(state.job)
+
+    def fail_calls(self, calls):
+        """Fail the programs of calls that could not be answered; yields the results of the samples that are done."""
+        for state, _, _, _, _ in calls:
+            if state.finished:
+                continue
+            self.executor.fail_program(state)
+            yield from self.advance_job(state.job)
+
+    def advance_job(self, job):
+        result = self.advance(job)
+        if result is not None:
+            self.num_active -= 1
+            yield result
+
+    def run(self, samples):
+        """Execute the programs of each sample and yield its result once it is done (in completion order)."""
+        self.executor.execution_stats = {'calls': 0, 'skipped': 0, 'programs': 0, 'executed_programs': 0}
+        # one Lucene searcher per retrieval thread, the executor's one for the first
+        searchers = [self.executor.searcher if i == 0 else self.executor.new_searcher() for i in range(self.retrieval_workers if self.open_book else 0)]
+        workers = [threading.Thread(target = self.retrieval_worker, args = (searcher,), daemon = True) for searcher in searchers]
+        workers.append(threading.Thread(target = self.inference_worker, daemon = True))
+        for worker in workers:
+            worker.start()
+
+        start_time = time.time()
+        samples = iter(samples)
+        self.num_active = 0
+        exhausted = False
+        while True:
+            # admission control: a bounded number of samples in flight
+            start = time.time()
+            finished = []
+            while not exhausted and self.num_active < self.max_samples:
+                sample = next(samples, None)
+                if sample is None:
+                    exhausted = True
+                    break
+                result, job = self.admit(sample)
+                if result is not None:
+                    finished.append(result)
+                else:
+                    self.num_active += 1
+            self.stats['bookkeeping'].add(time.time() - start, len(finished))
+            yield from finished
+            if exhausted and self.num_active == 0:
+                break
+
+            kind, payload = self.completion_queue.get()
+            if kind == 'error':
+                raise payload
+            start = time.time()
+            finished = list(self.complete(payload) if kind == 'answers' else self.fail_calls(payload))
+            self.stats['bookkeeping'].add(time.time() - start, len(payload))
+            yield from finished
+
+        # stop the stages in order: retrieval workers first, then inference
+        for _ in range(self.retrieval_workers if self.open_book else 0):
+            self.retrieval_queue.put(None)
+        for worker in workers[:-1]:
+            worker.join()
+        self.inference_queue.put(None)
+        workers[-1].join()
+
+        wall_seconds = time.time() - start_time
+        print(f"Pipeline ran {wall_seconds:.1f}s, {self.executor.execution_stats['calls']} calls, skipped {self.executor.execution_stats['skipped']} calls.")
+        for name, stats in self.stats.items():
+            if name != 'retrieval' or self.open_book:
+                print(f"  {stats.summary(wall_seconds)}")
+        print(f"  largest queues: retrieval {self.max_queue_sizes['retrieval']}, inference {self.max_queue_sizes['inference']}")
@@ -0,0 +1,75 @@
+import json
+
+class Program_State:
+    """Execution state of one program, so that many programs can be stepped together."""
+    def __init__(self, ID, program, evidence, program_ir = None) -> None:
+        self.ID = ID
+        self.program = program
+        self.program_ir = program_ir
+        self.evidence = evidence
+        self.graph = None
+        self.node_values = {}
+        # probabilities of the Verify answers, when they are scored
+        self.node_probabilities = {}
+        self.retrieved_evidence = []
+        self.final_answer = None
+        self.final_probability = None
+        self.finished = False
+        # nodes sent for execution by the pipeline and not answered yet
+        self.pending_nodes = set()
+
+class Vote_State:
+    """Weighted majority vote over the programs of a sample for adaptive voting.
+
+    Textually identical programs are executed once and vote with their
+    multiplicity; programs are executed most frequent first, and the vote
+    stops as soon as the remaining programs cannot change the majority.
+    """
+    def __init__(self, programs, program_irs) -> None:
+        groups = {}
+        for program, program_ir in zip(programs, program_irs):
+            key = json.dumps(program)
+            if key not in groups:
+                groups[key] = [program, program_ir, 0]
+            groups[key][2] += 1
+        self.pending = sorted(groups.values(), key = lambda entry: -entry[2])
+        self.true_votes, self.false_votes = 0, 0
+        # the label probability of each executed program, once per vote
+        self.probabilities = []
+
+    @property
+    def remaining_votes(self):
+        return sum([weight for _, _, weight in self.pending])
+
+    def is_decided(self, true_votes, false_votes, remaining_votes):
+        # ties go to False, as in aggregate_predictions
+        return true_votes > false_votes + remaining_votes or true_votes + remaining_votes <= false_votes
+
+    def next_programs(self):
+        """The fewest pending programs that decide the vote if they all agree (empty once it is decided)."""
+        remaining_votes = self.remaining_votes
+        if len(self.pending) == 0 or self.is_decided(self.true_votes, self.false_votes, remaining_votes):
+            return []
+        votes = 0
+        for count, (_, _, weight) in enumerate(self.pending):
+            votes += weight
+            remaining_votes -= weight
+            if self.is_decided(self.true_votes + votes, self.false_votes, remaining_votes) or \
+                self.is_decided(self.true_votes, self.false_votes + votes, remaining_votes):
+                return self.pending[:count + 1]
+        return list(self.pending)
+
+    def add_votes(self, entries, predictions, probabilities = None):
+        probabilities = probabilities if probabilities is not None else [None] * len(entries)
+        for entry, prediction, probability in zip(entries, predictions, probabilities):
+            self.pending.remove(entry)
+            if prediction == True:
+                self.true_votes += entry[2]
+            elif prediction == False:
+                self.false_votes += entry[2]
+            if probability is not None:
+                self.probabilities += [probability] * entry[2]
+
+    @property
+    def prediction(self):
+        return True if self.true_votes > self.false_votes else False
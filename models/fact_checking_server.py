@@ -0,0 +1,261 @@
+import argparse
+import json
+import time
+import queue
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from program_execution import Program_Execution, parse_args as parse_execution_args
+from program_generator import Reasoning_Program_Generator, text_to_program, parse_args as parse_generation_args
+from program_parser import parse_program
+from evaluate import latency_summary
+
+# Resident fact-checking service: the FLAN-T5 model, the retriever, their caches
+# and the program generator are loaded once, and concurrent POST /verify
+# requests are executed together in micro-batches. Arguments that are not
+# listed below are passed to Program_Execution, and --generator_* arguments to
+# the program generator (e.g. --generator_model_name, --generator_api_key).
+# Requests are JSON objects with a "claim", and optionally its "program" and,
+# in the gold setting, its "evidence":
+#   python fact_checking_server.py --port 8080 --setting open-book --corpus_index_path ... \
+#       --inference_backend cpu_fp32 --generator_model_name code-davinci-002 --generator_api_key ...
+
+GENERATOR_PREFIX = '--generator_'
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--max_batch_size', default=32, help='maximum number of requests executed together', type=int)
+    parser.add_argument('--max_wait', default=0.02, help='seconds to wait for more requests after the first one of a batch', type=float)
+    parser.add_argument('--max_latencies', default=100000, help='number of recent request latencies kept for the statistics', type=int)
+    args, other_args = parser.parse_known_args()
+
+    generator_argv, execution_argv = [], []
+    target = execution_argv
+    for arg in other_args:
+        if arg.startswith(GENERATOR_PREFIX):
+            target = generator_argv
+            arg = '--' + arg[len(GENERATOR_PREFIX):]
+        elif arg.startswith('--'):
+            target = execution_argv
+        target.append(arg)
+    args.execution_args = parse_execution_args(execution_argv)
+    # without --generator_* arguments, requests must come with their program
+    args.generation_args = parse_generation_args(generator_argv) if len(generator_argv) > 0 else None
+    if args.generation_args is not None and args.execution_args.dataset_name is not None:
+        args.generation_args.dataset_name = args.execution_args.dataset_name
+    return args
+
+class Verify_Request:
+    def __init__(self, claim, program = None, evidence = None) -> None:
+        self.claim = claim
+        self.program = program
+        self.evidence = evidence
+        self.programs = []
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Fact_Checking_Service:
+    """Answers verify requests with warm models, coalescing concurrent requests into micro-batches.
+
+    One worker thread takes the first waiting request, then the requests
+    arriving within `max_wait`, up to `max_batch_size`. It generates the
+    programs of the claims that came without one in a single batch, and runs
+    all programs of the batch with the batched executor, so that their
+    FLAN-T5 calls share model calls.
+    """
+    def __init__(self, executor, generator = None, max_batch_size = 32, max_wait = 0.02, max_latencies = 100000) -> None:
+        self.executor = executor
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen = max_latencies)
+        self.num_requests, self.num_batches, self.num_errors = 0, 0, 0
+        self.first_arrival_time, self.last_done_time = None, None
+        self.lock = threading.Lock()
+        # the statistics of the executor add up over all batches
+        self.executor.execution_stats = {'calls': 0, 'steps': 0, 'skipped': 0, 'programs': 0, 'executed_programs': 0}
+        self.worker = threading.Thread(target = self.batch_worker, daemon = True)
+        self.worker.start()
+
+    def verify(self, claim, program = None, evidence = None):
+        """Queue a request and wait for its result."""
+        request = Verify_Request(claim, program, evidence)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def get_batch(self):
+        """Block for one request, then take those arriving within `max_wait`, up to `max_batch_size`."""
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.requests.get(timeout = max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def batch_worker(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                self.execute_batch(batch)
+            except Exception as e:
+                print(f"Alert!!! batch of {len(batch)} requests failed: {e}")
+                for request in batch:
+                    request.error = e
+            done_time = time.time()
+            with self.lock:
+                self.num_batches += 1
+                for request in batch:
+                    if self.first_arrival_time is None or request.arrival_time < self.first_arrival_time:
+                        self.first_arrival_time = request.arrival_time
+                    if request.error is None:
+                        self.latencies.append(done_time - request.arrival_time)
+                    else:
+                        self.num_errors += 1
+                self.last_done_time = done_time
+            for request in batch:
+                request.done.set()
+
+    def execute_batch(self, batch):
+        to_generate = [request for request in batch if request.program is None]
+        if len(to_generate) > 0:
+            generated_programs = self.generator.generate_programs([request.claim for request in to_generate])
+            for request, programs in zip(to_generate, generated_programs):
+                request.programs = programs
+        for request in batch:
+            if request.program is not None:
+                request.programs = [request.program]
+
+        samples, requests = [], []
+        for request in batch:
+            if len(request.programs) == 0:
+                request.error = Exception("no program could be generated for the claim")
+                continue
+            self.num_requests += 1
+            sample = {'id': f'request-{self.num_requests}', 'claim': request.claim, 'gold': None,
+                      'predicted_programs': request.programs}
+            if request.evidence is not None:
+                self.executor.gold_evidence_map[sample['id']] = request.evidence
+            samples.append(sample)
+            requests.append(request)
+        if len(samples) == 0:
+            return
+        try:
+            results = list(self.executor.execute_chunk_batched(samples))
+        finally:
+            for sample in samples:
+                self.executor.gold_evidence_map.pop(sample['id'], None)
+        for request, result in zip(requests, results):
+            request.result = {'claim': request.claim, 'prediction': result['prediction'], 'programs': request.programs}
+            if 'probability' in result:
+                request.result['probability'] = result['probability']
+
+    def stats(self):
+        with self.lock:
+            wall_seconds = (self.last_done_time - self.first_arrival_time) if self.last_done_time is not None else 0.0
+            stats = latency_summary(list(self.latencies), wall_seconds)
+            stats['errors'] = self.num_errors
+            stats['batches'] = self.num_batches
+            stats['mean_batch_size'] = (len(self.latencies) + self.num_errors) / max(self.num_batches, 1)
+        stats['execution'] = dict(self.executor.execution_stats)
+        stats['answer_cache'] = self.executor.answer_cache.stats()
+        return stats
+
+class Fact_Checking_Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 connections drops bursts of concurrent clients
+    request_queue_size = 128
+
+class Fact_Checking_Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            self.send_json(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        self.send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/verify':
+            self.send_json(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            self.send_json(400, {'error': f'Invalid JSON: {e}'})
+            return
+        if not isinstance(request.get('claim'), str) or request['claim'].strip() == '':
+            self.send_json(400, {'error': 'A non-empty "claim" is required'})
+            return
+
+        # the program is a list of commands, or a string with one command per line
+        program = request.get('program')
+        if isinstance(program, str):
+            # clients usually end the text with a newline, which is not an empty command
+            program = text_to_program(program.strip())
+        if program is not None:
+            if not isinstance(program, list) or not all([isinstance(command, str) for command in program]):
+                self.send_json(400, {'error': 'The "program" must be a string or a list of commands'})
+                return
+            program_ir = parse_program(program)
+            # the executor runs malformed programs as the batch scripts do (e.g., unknown variables
+            # in Predict() are left out), so only programs with nothing to execute are rejected
+            if not any([command.c_type in ["VERIFY", "QUESTION", "FINAL"] for command in program_ir.commands]):
+                self.send_json(400, {'error': 'The program has no Verify/Question call and no Predict()', 'errors': program_ir.errors})
+                return
+            if not program_ir.is_valid:
+                print(f"Alert!!! malformed program for claim {request['claim']!r}: {program_ir.errors[0]}")
+        elif self.server.service.generator is None:
+            self.send_json(400, {'error': 'A "program" is required: the server was started without --generator_* arguments'})
+            return
+
+        if self.server.service.executor.args.setting == 'gold' and not isinstance(request.get('evidence'), str):
+            self.send_json(400, {'error': 'The gold setting needs the "evidence" of the claim'})
+            return
+
+        start = time.time()
+        try:
+            result = self.server.service.verify(request['claim'], program, request.get('evidence'))
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        result['latency'] = time.time() - start
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    args = parse_args()
+    executor = Program_Execution(args.execution_args)
+    generator = Reasoning_Program_Generator(args.generation_args) if args.generation_args is not None else None
+    service = Fact_Checking_Service(executor, generator, args.max_batch_size, args.max_wait, args.max_latencies)
+
+    server = Fact_Checking_Server((args.host, args.port), Fact_Checking_Handler)
+    server.service = service
+    print(f"Fact-checking service on http://{args.host}:{args.port} (POST /verify, GET /stats), "
+          f"batches of up to {args.max_batch_size} requests within {args.max_wait * 1000:.0f}ms")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(service.stats(), indent = 2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from abc import ABCMeta, abstractmethod
+
+from cache import hash_key
+
+class Program_Generation_Backend(metaclass=ABCMeta):
+    """
+        Base class for the models generating reasoning programs.
+        Subclasses implement the uncached generation; this class memoizes
+        completions in `cache` (a Persistent_Cache) when it is given.
+    """
+    def __init__(self, model_name, stop_words, max_new_tokens, cache = None) -> None:
+        self.model_name = model_name
+        self.stop_words = stop_words
+        self.max_new_tokens = max_new_tokens
+        self.cache = cache
+
+    def cache_key(self, input_string, temperature, sample_index = 0):
+        # deterministic completions do not depend on the sample index
+        sample_index = 0 if temperature == 0.0 else sample_index
+        return hash_key(self.model_name, hash_key(input_string), temperature, self.stop_words, self.max_new_tokens, sample_index)
+
+    @abstractmethod
+    def generate_uncached(self, input_string, temperature = 0.0):
+        """
+            Generate one completion of `input_string`.
+
+            Returns:
+                the generated text, stripped
+        """
+        pass
+
+    @abstractmethod
+    def batch_generate_uncached(self, messages_list, temperature = 0.0, on_result = None, n = 1):
+        """
+            Generate completions for a list of prompts.
+
+            on_result(index, output) is called as soon as the output of a prompt
+            is known. With n > 1 (or a list of n per prompt), each output is the
+            list of the n completions of the prompt.
+
+            Returns:
+                the outputs by prompt, None for the prompts that failed
+        """
+        pass
+
+    def generate(self, input_string, temperature = 0.0, sample_index = 0):
+        key = self.cache_key(input_string, temperature, sample_index)
+        if self.cache is not None:
+            generated_text = self.cache.get(key)
+            if generated_text is not None:
+                return generated_text
+
+        generated_text = self.generate_uncached(input_string, temperature)
+        if self.cache is not None:
+            self.cache.set(key, generated_text)
+        return generated_text
+
+    def batch_generate(self, messages_list, temperature = 0.0, on_result = None, sample_indices = None):
+        """Generate completions for a list of prompts.
+
+        With a cache, completions of (model, prompt, temperature, stop words,
+        max tokens, sample index) generated before are reused, and only the
+        other prompts are sent. `sample_indices` tells apart the samples of
+        the same prompt at temperature > 0.
+        """
+        sample_indices = sample_indices if sample_indices is not None else [0] * len(messages_list)
+        keys = [self.cache_key(message, temperature, sample_index) for message, sample_index in zip(messages_list, sample_indices)]
+        outputs = [None] * len(messages_list)
+        if self.cache is not None:
+            for index, key in enumerate(keys):
+                outputs[index] = self.cache.get(key)
+                if outputs[index] is not None and on_result is not None:
+                    on_result(index, outputs[index])
+
+        missing = [index for index, output in enumerate(outputs) if output is None]
+        if len(missing) == 0:
+            return outputs
+
+        def on_missing_result(missing_index, generated_text):
+            index = missing[missing_index]
+            # store each completion as soon as it arrives
+            if generated_text is not None and self.cache is not None:
+                self.cache.set(keys[index], generated_text)
+            if on_result is not None:
+                on_result(index, generated_text)
+
+        missing_messages = [messages_list[index] for index in missing]
+        missing_outputs = self.batch_generate_uncached(missing_messages, temperature, on_missing_result)
+        for index, output in zip(missing, missing_outputs):
+            outputs[index] = output
+        return outputs
+
+    def batch_generate_samples(self, messages_list, num_samples, temperature = 0.7, on_result = None):
+        """Generate `num_samples` completions per prompt with one request per prompt (the `n` parameter).
+
+        Returns, for each prompt, the list of its completions by sample index
+        (None for failed requests). Cached samples are reused and only the
+        missing ones are requested; their cache entries are shared with
+        `batch_generate`. on_result(index, completions) is called when all
+        completions of a prompt are known.
+        """
+        outputs = []
+        for message in messages_list:
+            outputs.append([self.cache.get(self.cache_key(message, temperature, sample_index)) if self.cache is not None else None
+                            for sample_index in range(num_samples)])
+        missing = []
+        for index, completions in enumerate(outputs):
+            if None in completions:
+                missing.append(index)
+            elif on_result is not None:
+                on_result(index, completions)
+        if len(missing) == 0:
+            return outputs
+
+        def on_missing_result(missing_index, generated_texts):
+            index = missing[missing_index]
+            missing_sample_indices = [sample_index for sample_index, text in enumerate(outputs[index]) if text is None]
+            if generated_texts is not None:
+                for sample_index, generated_text in zip(missing_sample_indices, generated_texts):
+                    outputs[index][sample_index] = generated_text
+                    if self.cache is not None:
+                        self.cache.set(self.cache_key(messages_list[index], temperature, sample_index), generated_text)
+            if on_result is not None:
+                on_result(index, outputs[index])
+
+        missing_messages = [messages_list[index] for index in missing]
+        missing_n = [len([text for text in outputs[index] if text is None]) for index in missing]
+        self.batch_generate_uncached(missing_messages, temperature, on_missing_result, missing_n)
+        return outputs
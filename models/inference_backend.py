@@ -0,0 +1,88 @@
+import importlib.util
+import torch
+from transformers import T5ForConditionalGeneration
+from abc import ABCMeta, abstractmethod
+
+class Inference_Backend(metaclass=ABCMeta):
+    """
+        Base class for the backends running the FLAN-T5 sub-task handlers.
+        A backend loads the model and tells on which device inputs go; the
+        loaded model must support `generate` like a Hugging Face model.
+    """
+    device = "cpu"
+
+    @abstractmethod
+    def load_model(self, model_name: str, cache_dir: str = None):
+        """
+            Load the seq2seq model `model_name` for inference.
+
+            Returns:
+                the model, ready to be used by T5_Question_Answering
+        """
+        pass
+
+class Parallelize_Backend(Inference_Backend):
+    """fp32 model split over all visible GPUs with `parallelize()` (default)."""
+    device = "cuda:0"
+
+    def load_model(self, model_name, cache_dir = None):
+        model = T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir)
+        model.parallelize()
+        return model
+
+class CPU_FP32_Backend(Inference_Backend):
+    """Plain fp32 inference on CPU, the reference for the other CPU backends."""
+    def load_model(self, model_name, cache_dir = None):
+        model = T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir)
+        return model.eval()
+
+class CPU_INT8_Backend(Inference_Backend):
+    """Dynamic int8 quantization of the linear layers, on CPU."""
+    def load_model(self, model_name, cache_dir = None):
+        model = T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir).eval()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype = torch.qint8)
+
+class CPU_BF16_Backend(Inference_Backend):
+    """bf16 weights and activations on CPU (fast on CPUs with AVX512-BF16/AMX)."""
+    def load_model(self, model_name, cache_dir = None):
+        model = T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir, torch_dtype = torch.bfloat16)
+        return model.eval()
+
+class Torch_Compile_Backend(Inference_Backend):
+    """fp32 on CPU with the encoder and decoder compiled by torch.compile (PyTorch >= 2.0)."""
+    def load_model(self, model_name, cache_dir = None):
+        if not hasattr(torch, 'compile'):
+            raise Exception("torch.compile requires PyTorch >= 2.0")
+        model = T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir).eval()
+        model.encoder.forward = torch.compile(model.encoder.forward, dynamic = True)
+        model.decoder.forward = torch.compile(model.decoder.forward, dynamic = True)
+        return model
+
+class CPU_Shared_Backend(Inference_Backend):
+    """fp32 on CPU with the weights memory-mapped from safetensors, shared by all processes loading them."""
+    def load_model(self, model_name, cache_dir = None):
+        if importlib.util.find_spec('accelerate') is None:
+            raise Exception("The cpu_shared backend requires accelerate to build the model without allocating its weights")
+        from shared_weights import load_mmap_model
+        return load_mmap_model(T5ForConditionalGeneration, model_name, cache_dir = cache_dir)
+
+class ONNX_Backend(Inference_Backend):
+    """Encoder-decoder exported to ONNX and run with ONNX Runtime on CPU (requires `optimum`)."""
+    def load_model(self, model_name, cache_dir = None):
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        return ORTModelForSeq2SeqLM.from_pretrained(model_name, export = True, cache_dir = cache_dir)
+
+INFERENCE_BACKENDS = {
+    'parallelize': Parallelize_Backend,
+    'cpu_fp32': CPU_FP32_Backend,
+    'cpu_int8': CPU_INT8_Backend,
+    'cpu_bf16': CPU_BF16_Backend,
+    'cpu_shared': CPU_Shared_Backend,
+    'torch_compile': Torch_Compile_Backend,
+    'onnx': ONNX_Backend,
+}
+
+def get_inference_backend(name):
+    if name not in INFERENCE_BACKENDS:
+        raise NotImplementedError(f"Unknown inference backend: {name}")
+    return INFERENCE_BACKENDS[name]()
@@ -0,0 +1,48 @@
+import os
+import json
+
+def iter_json_records(file_path):
+    """Iterate over the records of a JSON list file, or of a JSONL file line by line."""
+    if file_path.endswith('.jsonl'):
+        with open(file_path, 'r') as f:
+            for line in f:
+                if line.strip() != '':
+                    yield json.loads(line)
+    else:
+        with open(file_path, 'r') as f:
+            dataset = json.load(f)
+        for record in dataset:
+            yield record
+
+def read_jsonl(file_path):
+    """Read the records of a JSONL file written by `append_jsonl`.
+
+    A last line cut by a crash is skipped, and it is removed from the file
+    so that appending can resume after the last complete record.
+    """
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    complete_length = content.rfind(b'\n') + 1
+    if complete_length < len(content):
+        print(f"Alert!!! dropping incomplete last line of {file_path}")
+        with open(file_path, 'r+b') as f:
+            f.truncate(complete_length)
+    records = []
+    for line in content[:complete_length].decode('utf-8').split('\n'):
+        if line.strip() != '':
+            records.append(json.loads(line))
+    return records
+
+def append_jsonl(f, records):
+    """Append records to an open JSONL file and flush them to disk."""
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+def shard_file_name(file_name, shard_id, num_shards):
+    """`HOVER.program.jsonl` -> `HOVER.program.shard-0-of-4.jsonl`"""
+    root, extension = os.path.splitext(file_name)
+    return f'{root}.shard-{shard_id}-of-{num_shards}{extension}'
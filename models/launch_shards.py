@@ -0,0 +1,113 @@
+import argparse
+import itertools
+import os
+import sys
+import time
+import json
+import subprocess
+
+from io_utils import iter_json_records, read_jsonl, shard_file_name
+from evaluate import print_evaluation_results
+
+# Runs program_execution.py in --num_shards worker processes over disjoint
+# slices of the claims, then merges their JSONL outputs. Arguments that are
+# not listed below are passed to every worker, e.g.:
+#   python launch_shards.py --num_shards 8 --dataset_name HOVER --setting close-book \
+#       --FV_data_path ../datasets --program_dir ../results/programs --program_file_name ... \
+#       --output_dir ../results/fact_checking --inference_backend cpu_fp32
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_shards', default=4, type=int)
+    parser.add_argument('--threads_per_shard', default=None, help='torch threads per worker (default: CPU cores / num_shards)', type=int)
+    parser.add_argument('--pin_cores', action='store_true', help='pin each worker to its own CPU cores (Linux)')
+    parser.add_argument('--merge_only', action='store_true', help='only merge the outputs of earlier shard runs')
+    args, worker_args = parser.parse_known_args()
+
+    # arguments shared with the workers, needed to find and order their outputs
+    shared_parser = argparse.ArgumentParser()
+    shared_parser.add_argument('--dataset_name', type=str)
+    shared_parser.add_argument('--setting', type=str)
+    shared_parser.add_argument('--num_eval_samples', default=2000, type=int)
+    shared_parser.add_argument('--program_dir', type=str)
+    shared_parser.add_argument('--program_file_name', type=str)
+    shared_parser.add_argument('--output_dir', type=str)
+    shared_parser.add_argument("--model_name", default = 'google/flan-t5-xl', type=str)
+    shared_args, _ = shared_parser.parse_known_args(worker_args)
+    for key, value in vars(shared_args).items():
+        setattr(args, key, value)
+    args.worker_args = worker_args
+    if args.num_shards < 2:
+        raise Exception("launch_shards.py needs --num_shards >= 2; run program_execution.py directly for a single process")
+    return args
+
+def get_output_path(args):
+    # same layout as Program_Execution.get_output_path
+    output_path = os.path.join(args.output_dir, '{}_{}'.format(args.model_name.split('/')[-1], args.setting))
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    return output_path
+
+def launch_shards(args):
+    num_cores = os.cpu_count()
+    threads_per_shard = args.threads_per_shard if args.threads_per_shard is not None else max(1, num_cores // args.num_shards)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'program_execution.py')
+    output_path = get_output_path(args)
+
+    processes = []
+    for shard_id in range(args.num_shards):
+        # the merge reads the streamed shard files, whatever the worker arguments
+        command = [sys.executable, script] + args.worker_args + ['--streaming', '--num_shards', str(args.num_shards), '--shard_id', str(shard_id),
+                                                                 '--num_threads', str(threads_per_shard)]
+        env = dict(os.environ, OMP_NUM_THREADS = str(threads_per_shard), MKL_NUM_THREADS = str(threads_per_shard))
+        preexec_fn = None
+        if args.pin_cores:
+            cores = set([(shard_id * threads_per_shard + i) % num_cores for i in range(threads_per_shard)])
+            preexec_fn = lambda cores = cores: os.sched_setaffinity(0, cores)
+        log_file = open(os.path.join(output_path, f'shard-{shard_id}-of-{args.num_shards}.log'), 'w')
+        processes.append((subprocess.Popen(command, env = env, stdout = log_file, stderr = subprocess.STDOUT, preexec_fn = preexec_fn), log_file))
+    print(f"Started {args.num_shards} workers with {threads_per_shard} threads each, logs in {output_path}.")
+
+    start = time.time()
+    failed = []
+    for shard_id, (process, log_file) in enumerate(processes):
+        return_code = process.wait()
+        log_file.close()
+        print(f"Shard {shard_id} finished with code {return_code} after {time.time() - start:.1f}s.")
+        if return_code != 0:
+            failed.append(shard_id)
+    if len(failed) > 0:
+        print(f"Alert!!! shards {failed} failed; rerun the same command to resume them.")
+    return failed
+
+def merge_shards(args):
+    """Merge the JSONL outputs of the shards in the order of the program file, save and evaluate them."""
+    output_path = get_output_path(args)
+    results = {}
+    for shard_id in range(args.num_shards):
+        shard_file = os.path.join(output_path, shard_file_name(f'{args.dataset_name}.program.jsonl', shard_id, args.num_shards))
+        for result in read_jsonl(shard_file):
+            results[result['id']] = result
+
+    samples = iter_json_records(os.path.join(args.program_dir, args.program_file_name))
+    samples = samples if args.num_eval_samples < 0 else itertools.islice(samples, args.num_eval_samples)
+    sample_ids = [sample['id'] for sample in samples]
+    merged = [results[sample_id] for sample_id in sample_ids if sample_id in results]
+    if len(merged) < len(sample_ids):
+        print(f"Alert!!! {len(sample_ids) - len(merged)} of {len(sample_ids)} samples have no result.")
+    if len(merged) == 0:
+        # keep the results of an earlier merge rather than overwriting them with nothing
+        raise Exception(f"No shard results in {output_path}; nothing was merged")
+
+    with open(os.path.join(output_path, f'{args.dataset_name}.program.json'), 'w') as f:
+        f.write(json.dumps(merged, indent = 2))
+    print(f"Merged {len(merged)} results from {args.num_shards} shards.")
+    print_evaluation_results([result['prediction'] for result in merged], [result['gold'] for result in merged], num_of_classes=2)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.merge_only:
+        start = time.time()
+        launch_shards(args)
+        print(f"All shards done in {time.time() - start:.1f}s.")
+    merge_shards(args)
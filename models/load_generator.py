@@ -0,0 +1,96 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from io_utils import iter_json_records
+from evaluate import latency_summary
+
+# Sends POST /verify requests to fact_checking_server.py from a number of
+# concurrent clients and reports the throughput and the p50/p99 latency. Claims
+# come with their first program from a program file (--program_file), or alone
+# from the dev set (--FV_data_path), in which case the server generates them.
+# In the gold setting, the evidence of each claim is taken from the dev set.
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8080', type=str)
+    parser.add_argument('--program_file', default=None, help='JSON/JSONL file of the program generator; claims are sent with their first program', type=str)
+    parser.add_argument('--FV_data_path', default=None, help='send the claims of the dev set without programs (or, in the gold setting, their evidence)', type=str)
+    parser.add_argument('--dataset_name', default='HOVER', type=str)
+    parser.add_argument('--setting', default='open-book', help='[gold | open-book | close-book], as given to the server', type=str)
+    parser.add_argument('--num_requests', default=200, type=int)
+    parser.add_argument('--concurrency', default=16, help='number of clients sending requests at the same time', type=int)
+    parser.add_argument('--timeout', default=600, help='seconds before a request is given up', type=float)
+    args = parser.parse_args()
+    return args
+
+def load_dev_set(args):
+    with open(os.path.join(args.FV_data_path, args.dataset_name, 'claims', 'dev.json'), 'r') as f:
+        return json.load(f)
+
+def load_requests(args):
+    gold = args.setting == 'gold'
+    if gold and args.FV_data_path is None:
+        raise Exception("The gold setting sends the evidence of the dev set: give --FV_data_path")
+    if args.program_file is not None:
+        # program files have no evidence, it is joined from the dev set by claim id
+        gold_evidence_map = {sample['id']: sample['evidence'] for sample in load_dev_set(args)} if gold else {}
+        def get_evidence(sample):
+            if gold and sample['id'] not in gold_evidence_map:
+                raise Exception(f"Claim {sample['id']} of {args.program_file} is not in the {args.dataset_name} dev set")
+            return gold_evidence_map.get(sample['id'])
+        samples = iter_json_records(args.program_file)
+        requests = ({'claim': sample['claim'], 'program': sample['predicted_programs'][0], 'evidence': get_evidence(sample)}
+                    for sample in samples if len(sample['predicted_programs']) > 0)
+    elif args.FV_data_path is not None:
+        requests = [{'claim': sample['claim'], 'evidence': sample['evidence'] if gold else None} for sample in load_dev_set(args)]
+    else:
+        raise Exception("Give the claims to send with --program_file or --FV_data_path")
+    # cycle through the claims when more requests than claims are asked for
+    requests = list(itertools.islice(requests, args.num_requests))
+    return list(itertools.islice(itertools.cycle(requests), args.num_requests))
+
+def send_request(url, body, timeout):
+    request = urllib.request.Request(url, data = json.dumps(body).encode('utf-8'), headers = {'Content-Type': 'application/json'})
+    start = time.time()
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            json.loads(response.read())
+        return time.time() - start, None
+    except urllib.error.HTTPError as e:
+        return time.time() - start, f"{e.code}: {e.read().decode('utf-8', 'replace')}"
+    except Exception as e:
+        return time.time() - start, str(e)
+
+def main():
+    args = parse_args()
+    requests = load_requests(args)
+    url = args.url.rstrip('/')
+    print(f"Sending {len(requests)} requests to {url}/verify from {args.concurrency} clients...")
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = args.concurrency) as pool:
+        outcomes = list(pool.map(lambda body: send_request(url + '/verify', body, args.timeout), requests))
+    wall_seconds = time.time() - start
+
+    errors = [error for _, error in outcomes if error is not None]
+    summary = latency_summary([latency for latency, error in outcomes if error is None], wall_seconds)
+    print(f"{summary['requests']} requests succeeded, {len(errors)} failed in {wall_seconds:.1f}s.")
+    if len(errors) > 0:
+        print(f"Alert!!! first error: {errors[0]}")
+    if summary['requests'] > 0:
+        print(f"Throughput: {summary['throughput']:.2f} requests/s, latency p50 {summary['latency_p50'] * 1000:.0f}ms, p99 {summary['latency_p99'] * 1000:.0f}ms")
+
+    # the server side view: batch sizes and time spent queued included
+    with urllib.request.urlopen(url + '/stats', timeout = args.timeout) as response:
+        stats = json.loads(response.read())
+    print(f"Server: {stats['batches']} batches of {stats['mean_batch_size']:.1f} requests on average, "
+          f"{stats['execution']['calls']} calls, answer cache {stats['answer_cache']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from generation_backend import Program_Generation_Backend
+from prompts import DEMONSTRATION_SEPARATOR
+from prefix_cache import Prefix_KV_Cache, supports_prefix_kv
+
+class Stop_Words_Criteria(StoppingCriteria):
+    """Stops `generate` once every sequence of the batch contains a stop word."""
+    def __init__(self, tokenizer, stop_words, prompt_length) -> None:
+        self.tokenizer = tokenizer
+        self.stop_words = stop_words
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens = True)
+        return all([any([stop in text for stop in self.stop_words]) for text in texts])
+
+class Local_HF_Model(Program_Generation_Backend):
+    """Program generator running a local Hugging Face causal or seq2seq model.
+
+    Prompts are encoded in batches of similar length (left padding for causal
+    models), and completions are cut at the first stop word, as the OpenAI
+    `stop` parameter does. With `reuse_prefix_kv` (causal models only), the
+    key/values of the shared demonstrations are computed once and forked for
+    each batch of claims (see Prefix_KV_Cache).
+    """
+    def __init__(self, model_name, stop_words, max_new_tokens, cache = None, cache_dir = None, batch_size = 4,
+                 device = 'cpu', reuse_prefix_kv = False, prefix_cache_size = 4) -> None:
+        super().__init__(model_name, stop_words, max_new_tokens, cache)
+        self.device = device
+        self.batch_size = batch_size
+        self.stop_list = [stop_words] if isinstance(stop_words, str) else list(stop_words or [])
+
+        config = AutoConfig.from_pretrained(model_name, cache_dir = cache_dir)
+        self.is_encoder_decoder = config.is_encoder_decoder
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir = cache_dir)
+        if self.is_encoder_decoder:
+            self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name, cache_dir = cache_dir)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir = cache_dir)
+            self.tokenizer.padding_side = 'left'
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model.to(device).eval()
+
+        if reuse_prefix_kv and self.is_encoder_decoder:
+            print(f"Alert!!! prefix key/value reuse needs a causal model, {model_name} is encoder-decoder")
+            reuse_prefix_kv = False
+        elif reuse_prefix_kv and not supports_prefix_kv(self.model):
+            print(f"Alert!!! prefix key/value reuse does not support {config.model_type} models, generating without it")
+            reuse_prefix_kv = False
+        self.reuse_prefix_kv = reuse_prefix_kv
+        self.prefix_cache = Prefix_KV_Cache(self.model, self.tokenizer, device, prefix_cache_size) if reuse_prefix_kv else None
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens = False)['input_ids'])
+
+    def truncate_at_stop_words(self, text):
+        positions = [text.find(stop) for stop in self.stop_list if stop in text]
+        if len(positions) > 0:
+            text = text[:min(positions)]
+        return text.strip()
+
+    def sample_next_token(self, logits, temperature):
+        if temperature == 0.0:
+            return torch.argmax(logits, dim = -1)
+        probabilities = torch.softmax(logits.float() / temperature, dim = -1)
+        return torch.multinomial(probabilities, num_samples = 1).squeeze(-1)
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, temperature = 0.0):
+        encoded = self.tokenizer(prompts, padding = True, return_tensors = 'pt').to(self.device)
+        prompt_length = 1 if self.is_encoder_decoder else encoded['input_ids'].shape[1]
+        gen_kwargs = {'max_new_tokens': self.max_new_tokens, 'pad_token_id': self.tokenizer.pad_token_id,
+                      'stopping_criteria': StoppingCriteriaList([Stop_Words_Criteria(self.tokenizer, self.stop_list, prompt_length)])}
+        if temperature > 0.0:
+            gen_kwargs.update({'do_sample': True, 'temperature': temperature, 'top_p': 1.0, 'top_k': 0})
+        else:
+            gen_kwargs['do_sample'] = False
+        output_ids = self.model.generate(**encoded, **gen_kwargs)
+        texts = self.tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens = True)
+        return [self.truncate_at_stop_words(text) for text in texts]
+
+    def split_prefix(self, prompt):
+        """Split a prompt before its last claim: (shared demonstrations, claim part)."""
+        position = prompt.rfind(DEMONSTRATION_SEPARATOR)
+        if position < 0:
+            return '', prompt
+        # the line break stays in the prefix; whether both parts tokenize as the whole 
+        # prompt depends on the tokenizer, which split_matches_prompt checks
+        return prompt[:position + 1], prompt[position + 1:]
+
+    def split_matches_prompt(self, prompt, prefix, suffix):
+        """Whether the token ids of prefix and suffix, as Prefix_KV_Cache encodes them, are those of the prompt."""
+        prefix_ids = self.tokenizer(prefix)['input_ids']
+        suffix_ids = self.tokenizer(suffix, add_special_tokens = False)['input_ids']
+        return prefix_ids + suffix_ids == self.tokenizer(prompt)['input_ids']
+
+    def generate_with_prefix_cache(self, prefix, suffixes, temperature = 0.0):
+        def is_finished(token_ids):
+            text = self.tokenizer.decode(token_ids, skip_special_tokens = True)
+            return any([stop in text for stop in self.stop_list])
+        generated_ids = self.prefix_cache.generate(prefix, suffixes, self.max_new_tokens,
+                                                   lambda logits: self.sample_next_token(logits, temperature), is_finished)
+        texts = self.tokenizer.batch_decode(generated_ids, skip_special_tokens = True)
+        return [self.truncate_at_stop_words(text) for text in texts]
+
+    def generate_rows(self, prompts, temperature = 0.0):
+        """Generate one completion per prompt; with the prefix cache, prompts must share their prefix."""
+        if not self.reuse_prefix_kv:
+            return self.generate_batch(prompts, temperature)
+        prefix = self.split_prefix(prompts[0])[0]
+        if prefix == '':
+            return self.generate_batch(prompts, temperature)
+        suffixes = [self.split_prefix(prompt)[1] for prompt in prompts]
+        if not all([self.split_matches_prompt(prompt, prefix, suffix) for prompt, suffix in zip(prompts, suffixes)]):
+            # the model would see other tokens than with the whole prompt
+            print(f"Alert!!! the prompt prefix and suffix of {self.model_name} do not tokenize as the whole prompt, generating without prefix key/value reuse")
+            self.reuse_prefix_kv = False
+            return self.generate_batch(prompts, temperature)
+        return self.generate_with_prefix_cache(prefix, suffixes, temperature)
+
+    def generate_uncached(self, input_string, temperature = 0.0):
+        return self.generate_rows([input_string], temperature)[0]
+
+    def batch_generate_uncached(self, messages_list, temperature = 0.0, on_result = None, n = 1):
+        multiple = isinstance(n, list) or n > 1
+        num_samples = n if isinstance(n, list) else [n] * len(messages_list)
+        # one row per completion; rows of similar length (and, with the prefix
+        # cache, of the same prefix) are batched together
+        rows = [index for index, count in enumerate(num_samples) for _ in range(count)]
+        lengths = [len(ids) for ids in self.tokenizer(messages_list)['input_ids']]
+        groups = {}
+        for index in rows:
+            prefix = self.split_prefix(messages_list[index])[0] if self.reuse_prefix_kv else ''
+            groups.setdefault(prefix, []).append(index)
+
+        batches = []
+        for group_rows in groups.values():
+            group_rows = sorted(group_rows, key = lambda index: lengths[index])
+            batches += [group_rows[start:start + self.batch_size] for start in range(0, len(group_rows), self.batch_size)]
+
+        completions = [[] for _ in messages_list]
+        for batch_rows in batches:
+            texts = self.generate_rows([messages_list[index] for index in batch_rows], temperature)
+            for index, text in zip(batch_rows, texts):
+                completions[index].append(text)
+                if len(completions[index]) == num_samples[index] and on_result is not None:
+                    on_result(index, completions[index] if multiple else text)
+        return [texts if multiple else texts[0] for texts in completions]
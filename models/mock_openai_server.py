@@ -0,0 +1,94 @@
+import argparse
+import json
+import time
+import random
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI completions endpoints, to test request scheduling
+# without an API key: point the generator to it with --api_base http://localhost:8000/v1
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--requests_per_minute', default=60, help='requests beyond this rate get a 429', type=int)
+    parser.add_argument('--rate_limit_probability', default=0.0, help='probability of a spurious 429', type=float)
+    parser.add_argument('--latency', default=0.5, help='seconds per response', type=float)
+    args = parser.parse_args()
+    return args
+
+def mock_program(prompt):
+    """A one-line program verifying the last claim of the prompt."""
+    claim = prompt.split('# The claim is that')[-1].split('\n')[0].strip()
+    claim = claim.replace('"', "'")
+    return f'fact_1 = Verify("{claim}")\n    label = Predict(fact_1)'
+
+class Mock_OpenAI_Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, body, headers = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def rate_limited(self):
+        server = self.server
+        with server.lock:
+            now = time.monotonic()
+            while len(server.request_times) > 0 and now - server.request_times[0] >= 60.0:
+                server.request_times.popleft()
+            if len(server.request_times) >= server.args.requests_per_minute or random.random() < server.args.rate_limit_probability:
+                server.num_rate_limited += 1
+                return True
+            server.request_times.append(now)
+            server.num_served += 1
+            return False
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path.rstrip('/') not in ['/v1/completions', '/v1/chat/completions']:
+            self.send_json(404, {'error': {'message': f'Unknown endpoint {self.path}', 'type': 'invalid_request_error'}})
+            return
+        if self.rate_limited():
+            self.send_json(429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                           {'Retry-After': '1'})
+            return
+
+        time.sleep(self.server.args.latency)
+        n = request.get('n', 1)
+        if self.path.rstrip('/') == '/v1/completions':
+            prompt = request.get('prompt', '')
+            choices = [{'text': mock_program(prompt), 'index': i, 'logprobs': None, 'finish_reason': 'stop'} for i in range(n)]
+            response_object = 'text_completion'
+        else:
+            prompt = request.get('messages', [{}])[-1].get('content', '')
+            choices = [{'message': {'role': 'assistant', 'content': mock_program(prompt)}, 'index': i, 'finish_reason': 'stop'} for i in range(n)]
+            response_object = 'chat.completion'
+        self.send_json(200, {'id': f'mock-{time.time()}', 'object': response_object, 'created': int(time.time()),
+                             'model': request.get('model'), 'choices': choices,
+                             'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': 16 * n, 'total_tokens': len(prompt) // 4 + 16 * n}})
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    args = parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), Mock_OpenAI_Handler)
+    server.args = args
+    server.lock = threading.Lock()
+    server.request_times = deque()
+    server.num_served, server.num_rate_limited = 0, 0
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1 ({args.requests_per_minute} requests per minute)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Served {server.num_served} requests, answered {server.num_rate_limited} with 429.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import torch
+import inspect
+from collections import OrderedDict
+
+from cache import hash_key
+
+# architectures whose legacy cache holds, per layer, a (key, value) pair of tensors with the
+# batch first, as fork_cache expects; Bloom folds the heads into the batch dimension and
+# GPTBigCode fuses the key and the value into one tensor
+PREFIX_KV_MODEL_TYPES = ['gpt2', 'gpt_neo', 'gptj', 'codegen', 'llama', 'mistral']
+
+def supports_prefix_kv(model):
+    """Whether Prefix_KV_Cache can run `model`: a supported cache layout and a forward taking 
+    position_ids (e.g., OPT and GPT-NeoX do not on transformers 4.25)."""
+    if model.config.model_type not in PREFIX_KV_MODEL_TYPES:
+        return False
+    return 'position_ids' in inspect.signature(model.forward).parameters
+
+def to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def fork_cache(legacy_cache, batch_size):
+    """Key/values of `legacy_cache` shared by `batch_size` rows, as a cache the model can extend.
+
+    The prefix tensors are expanded, not copied, and the model appends new
+    key/values to new tensors, so the cached prefix is never modified.
+    """
+    legacy_cache = tuple([tuple([tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer]) for layer in legacy_cache])
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return legacy_cache
+    return DynamicCache.from_legacy_cache(legacy_cache)
+
+class Prefix_KV_Cache:
+    """Key/values of shared prompt prefixes (e.g., the demonstrations of a template) for a causal model.
+
+    The prefill of a prefix runs once; each batch of prompts starting with it
+    forks its key/values and only runs the prompt suffixes, so that the cost
+    of a prompt grows with its suffix (the claim), not with the demonstrations.
+    """
+    def __init__(self, model, tokenizer, device = 'cpu', max_prefixes = 4) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_prefixes = max_prefixes
+        self.prefixes = OrderedDict()
+        self.num_prefill_tokens, self.num_reused_tokens = 0, 0
+
+    @torch.no_grad()
+    def get(self, prefix):
+        """Returns (key/values, number of tokens) of `prefix`, computing them on the first call."""
+        key = hash_key(prefix)
+        if key in self.prefixes:
+            self.prefixes.move_to_end(key)
+            return self.prefixes[key]
+        input_ids = self.tokenizer(prefix, return_tensors = 'pt')['input_ids'].to(self.device)
+        outputs = self.model(input_ids = input_ids, use_cache = True)
+        self.num_prefill_tokens += input_ids.shape[1]
+        self.prefixes[key] = (to_legacy_cache(outputs.past_key_values), input_ids.shape[1])
+        while len(self.prefixes) > self.max_prefixes:
+            self.prefixes.popitem(last = False)
+        return self.prefixes[key]
+
+    @torch.no_grad()
+    def generate(self, prefix, suffixes, max_new_tokens, sample_next_token, is_finished):
+        """Decode the continuations of prefix + suffix for a batch of suffixes.
+
+        sample_next_token(logits) picks the next tokens of the batch, and
+        is_finished(token_ids) tells whether a continuation is complete
+        (e.g., it contains a stop word). Returns the generated token ids.
+        """
+        legacy_cache, prefix_length = self.get(prefix)
+        self.num_reused_tokens += prefix_length * len(suffixes)
+        past_key_values = fork_cache(legacy_cache, len(suffixes))
+
+        # suffixes are left padded: the padding sits between the prefix and the
+        # suffix, so it is masked and positions continue after the prefix
+        encoded = self.tokenizer(suffixes, add_special_tokens = False, padding = True, return_tensors = 'pt').to(self.device)
+        self.num_prefill_tokens += int(encoded['attention_mask'].sum())
+        input_ids = encoded['input_ids']
+        suffix_mask = encoded['attention_mask']
+        attention_mask = torch.cat([torch.ones((len(suffixes), prefix_length), dtype = suffix_mask.dtype, device = self.device), suffix_mask], dim = 1)
+        position_ids = prefix_length + suffix_mask.cumsum(-1) - 1
+        position_ids = position_ids.masked_fill(suffix_mask == 0, prefix_length)
+
+        generated_ids = [[] for _ in suffixes]
+        finished = [False] * len(suffixes)
+        for _ in range(max_new_tokens):
+            outputs = self.model(input_ids = input_ids, attention_mask = attention_mask, position_ids = position_ids,
+                                 past_key_values = past_key_values, use_cache = True)
+            past_key_values = outputs.past_key_values
+            next_tokens = sample_next_token(outputs.logits[:, -1, :])
+            for row, token in enumerate(next_tokens.tolist()):
+                if finished[row]:
+                    continue
+                if token == self.tokenizer.eos_token_id:
+                    finished[row] = True
+                    continue
+                generated_ids[row].append(token)
+                finished[row] = is_finished(generated_ids[row])
+            if all(finished):
+                break
+            input_ids = next_tokens.unsqueeze(-1)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim = 1)
+            position_ids = position_ids[:, -1:] + 1
+        return generated_ids
+
+    def stats(self):
+        return f"{len(self.prefixes)} prefixes, {self.num_prefill_tokens} prefill tokens, {self.num_reused_tokens} prefix tokens reused"
@@ -0,0 +1,116 @@
+from program_parser import parse_program
+from program_evaluator import needed_variables
+
+class Program_Node:
+    """A single command of a reasoning program.
+
+    `ir` is the parsed command (a Program_Command). `dependencies` maps each
+    variable used by the command to the index of the node that assigns it.
+    `order_dependencies` are nodes that must run before this one although no
+    value flows from them.
+    """
+    def __init__(self, index, ir, return_var = None, argument = None, dependencies = None, order_dependencies = None) -> None:
+        self.index = index
+        self.ir = ir
+        self.c_type = ir.c_type
+        self.command = ir.text
+        self.return_var = return_var
+        self.argument = argument
+        self.dependencies = dependencies if dependencies is not None else {}
+        self.order_dependencies = order_dependencies if order_dependencies is not None else []
+
+    @property
+    def parents(self):
+        return set(self.dependencies.values()) | set(self.order_dependencies)
+
+    def resolve_argument(self, node_values):
+        argument = self.argument
+        for variable_name, node_index in self.dependencies.items():
+            argument = argument.replace("{" + variable_name + "}", str(node_values[node_index]))
+        return argument
+
+    def resolve_variables(self, node_values):
+        # calls skipped by lazy execution have no value
+        return {variable_name: node_values[node_index] for variable_name, node_index in self.dependencies.items() if node_index in node_values}
+
+class Program_Graph:
+    """Dependency graph (DAG) of the Verify/Question/Predict calls of a program.
+
+    Edges come from `{answer_1}`-style references in Verify/Question arguments
+    and from the variables used in Predict(). Calls without a path between
+    them can be executed at the same time.
+    """
+    def __init__(self, program, nodes, final_node) -> None:
+        self.program = program
+        self.nodes = nodes
+        self.final_node = final_node
+
+    @property
+    def call_nodes(self):
+        return [node for node in self.nodes if node.c_type in ["VERIFY", "QUESTION"]]
+
+    def ready_nodes(self, node_values):
+        """Call nodes not executed yet whose dependencies all have a value."""
+        return [node for node in self.call_nodes
+                if node.index not in node_values and all(index in node_values for index in node.parents)]
+
+    @property
+    def can_short_circuit(self):
+        return self.final_node is not None and self.final_node.ir.expression is not None
+
+    def pending_chain(self, index, node_values):
+        """Nodes not executed yet that node `index` needs, itself included, in execution order."""
+        chain = set()
+        stack = [index]
+        while len(stack) > 0:
+            index = stack.pop()
+            if index in chain or index in node_values:
+                continue
+            chain.add(index)
+            stack += list(self.nodes[index].parents)
+        return [self.nodes[index] for index in sorted(chain)]
+
+    def needed_chains(self, node_values):
+        """For each Predict() operand that can still change the label, the nodes to execute to get its value.
+
+        A Predict() operand that already decides the label (e.g., a False
+        operand of `and`) makes the calls behind the other operands unneeded.
+        """
+        final_node = self.final_node
+        values = final_node.resolve_variables(node_values)
+        return [self.pending_chain(final_node.dependencies[name], node_values)
+                for name in needed_variables(final_node.ir.expression, values) if name in final_node.dependencies]
+
+def compile_program(program, program_ir = None):
+    """Compile a list of program commands, or their Program_IR, into a Program_Graph.
+
+    A command depends on the latest earlier command assigning each variable
+    it uses. A command re-assigning a variable also waits for the earlier
+    commands that write or read it, so the graph keeps the sequential semantics.
+    """
+    program_ir = program_ir if program_ir is not None else parse_program(program)
+    nodes = []
+    writers = {}
+    readers = {}
+    for index, command in enumerate(program_ir.commands):
+        if command.c_type in ["VERIFY", "QUESTION"]:
+            return_var = command.target
+            dependencies = {name: writers[name] for name in command.slots if name in writers}
+            # keep earlier reads and writes of the re-assigned variable before this one
+            order_dependencies = [writers[return_var]] if return_var in writers else []
+            order_dependencies += readers.get(return_var, [])
+            node = Program_Node(index, command, return_var, command.template, dependencies, order_dependencies)
+            for name in dependencies:
+                readers.setdefault(name, []).append(index)
+            writers[return_var] = index
+            readers[return_var] = []
+        elif command.c_type == "FINAL":
+            dependencies = {name: writers[name] for name in command.variables if name in writers}
+            node = Program_Node(index, command, dependencies = dependencies)
+        else:
+            node = Program_Node(index, command)
+        nodes.append(node)
+
+    # the label is only defined when the program ends with Predict()
+    final_node = nodes[-1] if len(nodes) > 0 and nodes[-1].c_type == "FINAL" else None
+    return Program_Graph(program, nodes, final_node)
@@ -0,0 +1,61 @@
+# Predict() expressions are evaluated over the tree built by program_parser,
+# never with eval(). Variables without a value yet are unknown (None), and
+# and/or short-circuit: an `and` with a False operand is False whatever its
+# unknown operands turn out to be, so the calls behind them can be skipped.
+
+def evaluate_expression(expression, values):
+    """Three-valued evaluation: True, False, or None when the unknown variables can still decide it."""
+    operator = expression[0]
+    if operator == 'var':
+        value = values.get(expression[1])
+        return None if value is None else bool(value)
+    if operator == 'not':
+        value = evaluate_expression(expression[1], values)
+        return None if value is None else not value
+
+    # `and` is decided by a False operand, `or` by a True one
+    deciding_value = False if operator == 'and' else True
+    unknown = False
+    for operand in expression[1:]:
+        value = evaluate_expression(operand, values)
+        if value == deciding_value:
+            return deciding_value
+        unknown = unknown or value is None
+    return None if unknown else not deciding_value
+
+def needed_variables(expression, values):
+    """Variables without a value that can still change the result, in order of appearance."""
+    if evaluate_expression(expression, values) is not None:
+        return []
+    if expression[0] == 'var':
+        return [expression[1]]
+    variables = []
+    for operand in expression[1:]:
+        variables += [name for name in needed_variables(operand, values) if name not in variables]
+    return variables
+
+def prune_expression(expression, defined):
+    """Drop the operands using variables that are not in `defined` (None when nothing is left)."""
+    operator = expression[0]
+    if operator == 'var':
+        return expression if expression[1] in defined else None
+    operands = [operand for operand in [prune_expression(operand, defined) for operand in expression[1:]] if operand is not None]
+    if len(operands) == 0:
+        return None
+    if operator == 'not':
+        return ['not', operands[0]]
+    return operands[0] if len(operands) == 1 else [operator] + operands
+
+def expression_probability(expression, probabilities):
+    """Probability of the expression being True, taking its variables as independent events."""
+    operator = expression[0]
+    if operator == 'var':
+        return probabilities[expression[1]]
+    if operator == 'not':
+        return 1.0 - expression_probability(expression[1], probabilities)
+    # `and`: all operands are True; `or`: not all of them are False
+    probability = 1.0
+    for operand in expression[1:]:
+        operand_probability = expression_probability(operand, probabilities)
+        probability *= operand_probability if operator == 'and' else 1.0 - operand_probability
+    return probability if operator == 'and' else 1.0 - probability
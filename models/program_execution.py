@@ -1,16 +1,28 @@
+import time
+# taken before the heavy imports, for the startup breakdown
+IMPORT_START = time.time()
 import argparse
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+import torch
+from transformers import T5Tokenizer, T5TokenizerFast
 import random
 from tqdm import tqdm
-import re
 import os
 import json
+import itertools
 
 from question_answering import T5_Question_Answering
 from retriever import PyseriniRetriever
 from evaluate import print_evaluation_results
+from program_compiler import compile_program
+from program_parser import load_program_ir, expression_variables
+from program_evaluator import evaluate_expression, prune_expression, expression_probability
+from execution_state import Program_State, Vote_State
+from execution_pipeline import Execution_Pipeline
+from cache import Persistent_Cache
+from io_utils import iter_json_records, read_jsonl, append_jsonl, shard_file_name
+from inference_backend import INFERENCE_BACKENDS, get_inference_backend
 
-def parse_args():
+def parse_args(argv = None):
     parser = argparse.ArgumentParser()
     # dataset args
     parser.add_argument('--dataset_name', type=str)
@@ -20,40 +32,103 @@ def parse_args():
     parser.add_argument('--program_dir', type=str)
     parser.add_argument('--program_file_name', type=str)
     parser.add_argument('--output_dir', type=str)
+    parser.add_argument('--streaming', action='store_true', help='append each result to a JSONL file as soon as it is done, and skip finished samples on restart')
+    # sharding args (see launch_shards.py)
+    parser.add_argument('--num_shards', default=1, help='split the claims over this many processes; implies --streaming', type=int)
+    parser.add_argument('--shard_id', default=0, help='claims i with i %% num_shards == shard_id are executed by this process', type=int)
+    parser.add_argument('--num_threads', default=None, help='number of torch CPU threads of this process', type=int)
     # fact checker args
     parser.add_argument("--model_name", default = 'google/flan-t5-xl', type=str)
     parser.add_argument("--cache_dir", type=str)
+    parser.add_argument('--slow_tokenizer', action='store_true', help='use the sentencepiece T5Tokenizer instead of the Rust T5TokenizerFast')
     parser.add_argument('--corpus_index_path', default=None, type=str)
     parser.add_argument('--num_retrieved', default=5, type=int)
+    parser.add_argument('--retrieval_threads', default=8, help='number of threads for batched BM25 retrieval', type=int)
     parser.add_argument('--max_evidence_length', default=3000, help = 'to avoid exceeding GPU memory', type=int)
-    args = parser.parse_args()
+    parser.add_argument('--inference_backend', default='parallelize', choices=list(INFERENCE_BACKENDS), help='how the sub-task model is run: [parallelize (GPUs) | cpu_fp32 | cpu_int8 | cpu_bf16 | cpu_shared | torch_compile | onnx]', type=str)
+    # batched execution args
+    parser.add_argument('--batch_execution', action='store_true', help='execute all programs of a chunk of claims step by step, batching the sub-task calls')
+    parser.add_argument('--adaptive_voting', action='store_true', help='execute identical sampled programs once and stop when the remaining programs cannot change the majority vote')
+    parser.add_argument('--lazy_execution', action='store_true', help='skip the calls that cannot change the label once Predict() is decided (e.g., after a False operand of `and`)')
+    parser.add_argument('--execution_batch_size', default=32, help='number of claims executed together in batched mode', type=int)
+    parser.add_argument('--qa_batch_size', default=16, help='maximum number of prompts per FLAN-T5 call in batched mode', type=int)
+    parser.add_argument('--max_batch_tokens', default=16384, help='maximum number of padded input tokens per FLAN-T5 call in batched mode', type=int)
+    parser.add_argument('--verify_scoring', default='generate', choices=['generate', 'logits'], help='answer Verify calls by decoding [generate] or by comparing the true/false label logits of one decoder step [logits]', type=str)
+    parser.add_argument('--shared_evidence_encoding', action='store_true', help='encode each evidence once and reuse it for all sub-questions on it (fusion-in-decoder style approximation)')
+    parser.add_argument('--evidence_cache_size', default=16, help='number of encoded evidence blocks kept on the device', type=int)
+    # pipelined execution args
+    parser.add_argument('--pipeline', action='store_true', help='overlap retrieval and FLAN-T5 inference in a staged pipeline; --execution_batch_size claims are in flight')
+    parser.add_argument('--pipeline_queue_size', default=256, help='capacity of the queues between the pipeline stages', type=int)
+    parser.add_argument('--retrieval_workers', default=1, help='threads of the retrieval stage, each searching batches of queries', type=int)
+    parser.add_argument('--retrieval_batch_size', default=16, help='maximum number of queries searched together by a retrieval worker', type=int)
+    parser.add_argument('--inference_batch_size', default=64, help='maximum number of calls taken at once by the inference stage', type=int)
+    # cache args
+    parser.add_argument('--answer_cache_path', default=None, help='sqlite file to persist sub-task answers across runs', type=str)
+    parser.add_argument('--answer_cache_size', default=100000, help='number of answers kept in memory', type=int)
+    parser.add_argument('--retrieval_cache_path', default=None, help='sqlite file to persist retrieved hits across runs', type=str)
+    args = parser.parse_args(argv)
     return args
 
+class Startup_Timer:
+    """Wall time of the startup phases, reported before the first claim."""
+    def __init__(self, start) -> None:
+        self.last = start
+        self.phases = []
+
+    def phase(self, name):
+        """Close the phase `name`, which ran since the previous one."""
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def summary(self):
+        total = sum([seconds for _, seconds in self.phases])
+        return f"Startup took {total:.1f}s: " + ", ".join([f"{name} {seconds:.1f}s" for name, seconds in self.phases])
+
 class Program_Execution:
     def __init__(self, args) -> None:
+        timer = Startup_Timer(IMPORT_START)
+        timer.phase('imports')
         # load model
         self.args = args
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
         CACHE_DIR = args.cache_dir
         self.model_name = args.model_name
         self.dataset_name = args.dataset_name
         print(f"Loading model {self.model_name}...")
-        self.tokenizer = T5Tokenizer.from_pretrained(self.model_name, cache_dir= CACHE_DIR)
-        self.model = T5ForConditionalGeneration.from_pretrained(self.model_name, cache_dir= CACHE_DIR)
-        self.model.parallelize()
-        print(f"Model {self.model_name} loaded.")
+        tokenizer_class = T5Tokenizer if args.slow_tokenizer else T5TokenizerFast
+        self.tokenizer = tokenizer_class.from_pretrained(self.model_name, cache_dir= CACHE_DIR)
+        timer.phase('tokenizer')
+        self.backend = get_inference_backend(args.inference_backend)
+        self.model = self.backend.load_model(self.model_name, cache_dir= CACHE_DIR)
+        print(f"Model {self.model_name} loaded with the {args.inference_backend} backend.")
+        timer.phase('model')
 
-        self.QA_module = T5_Question_Answering(self.model, self.tokenizer)
+        self.answer_cache = Persistent_Cache(args.answer_cache_path, table = 'answers', max_memory_items = args.answer_cache_size)
+        # reduced precision backends may answer differently, so they get their own cache entries
+        cache_model_name = self.model_name if args.inference_backend in ['parallelize', 'cpu_fp32', 'cpu_shared'] else f"{self.model_name}:{args.inference_backend}"
+        self.QA_module = T5_Question_Answering(self.model, self.tokenizer, cache_model_name, self.answer_cache, 
+                                               args.shared_evidence_encoding, args.evidence_cache_size, self.backend.device, 
+                                               args.verify_scoring)
+        timer.phase('caches')
 
         # load retriever
         if self.args.setting == 'open-book':
-            self.searcher = PyseriniRetriever(self.args.corpus_index_path, use_bm25=True, k1=0.9, b=0.4)
+            self.retrieval_cache = Persistent_Cache(args.retrieval_cache_path, table = 'hits')
+            self.searcher = self.new_searcher()
         else:
             self.searcher = None
+        timer.phase('retriever')
 
-        # load dataset
-        with open(os.path.join(args.FV_data_path, args.dataset_name, 'claims', f'dev.json'), 'r') as f:
-            dataset = json.load(f)
-        self.gold_evidence_map = {sample['id']:sample['evidence'] for sample in dataset}
+        # load dataset (the fact-checking service runs without it)
+        self.gold_evidence_map = {}
+        if args.FV_data_path is not None:
+            with open(os.path.join(args.FV_data_path, args.dataset_name, 'claims', f'dev.json'), 'r') as f:
+                dataset = json.load(f)
+            self.gold_evidence_map = {sample['id']:sample['evidence'] for sample in dataset}
+        timer.phase('dataset')
+        print(timer.summary())
 
     def map_direct_answer_to_label(self, predict):
         predict = predict.lower().strip()
@@ -64,57 +139,21 @@ class Program_Execution:
             print(f"Alert!!! wrong answer mapping: {predict}")
             return random.sample([True, False], 1)[0]
 
-    def parse_verify_command(self, command, variable_map):
-        return_var, tmp = command.split('= Verify')
-        return_var = return_var.strip()
-        # claim = tmp.replace("\")", "").strip()
-
-        p1 = re.compile(f'Verify\([f]?\"(.*)\"\)', re.S)
-        matching = re.findall(p1, command)
-        claim = matching[0] if len(matching)>0 else tmp
-
-        # replace variable
-        for variable_name, variable_value in variable_map.items():
-            replace_var = "{" + str(variable_name) + "}"
-            if claim.find(replace_var) >=0:
-                claim = claim.replace(replace_var, variable_value)
-
-        return return_var, claim
-
-    def parse_question_command(self, command, variable_map):
-        return_var, tmp = command.split('= Question')
-        return_var = return_var.strip()
-        # question = tmp.replace("\")", "").strip()
-
-        p1 = re.compile(f'Question\([f]?\"(.*)\"\)', re.S)
-        matching = re.findall(p1, command)
-        question = matching[0] if len(matching)>0 else tmp
-
-        # replace variable
-        for variable_name, variable_value in variable_map.items():
-            replace_var = "{" + str(variable_name) + "}"
-            if question.find(replace_var) >=0:
-                question = question.replace(replace_var, variable_value)
-
-        return return_var, question
-
-    def get_command_type(self, command):
-        if command.find("label = ")>=0:
-            return "FINAL"
-        elif command.find('= Verify')>=0:
-            return "VERIFY"
-        elif command.find('= Question')>=0:
-            return "QUESTION"
-        else:
-            return "UNKNOWN"
-
     def derive_final_answer(self, command, variable_map):
+        if command.expression is not None:
+            final_label = evaluate_expression(command.expression, variable_map)
+            if final_label is not None:
+                return final_label
+            # variables never assigned by the program are left out of the expression
+            for argument in expression_variables(command.expression):
+                if argument not in variable_map:
+                    print(f"Alert!!! wrong argument: {argument}")
+            expression = prune_expression(command.expression, variable_map)
+            return True if expression is None else evaluate_expression(expression, variable_map)
+
+        # Predict() arguments that do not parse are split on " and " as they are
         final_label = True
-        command = command.replace('label =', '').strip()
-        p1 = re.compile(r'Predict[(](.*?)[)]', re.S)
-        command_arg = re.findall(p1, command)[0]
-        verify_subs = command_arg.split(" and ")
-        arguments = [arg.strip() for arg in verify_subs]
+        arguments = [arg.strip() for arg in command.argument.split(" and ")]
         for argument in arguments:
             if argument in variable_map:
                 final_label = variable_map[argument] and final_label
@@ -122,8 +161,29 @@ class Program_Execution:
                 print(f"Alert!!! wrong argument: {argument}")
         return final_label
 
+    def program_probability(self, command, probabilities):
+        """Probability of a program's label from the probabilities of its Verify calls (--verify_scoring logits). 
+        Calls that were not executed or not scored are left out; None when nothing is left."""
+        if command.expression is None:
+            return None
+        expression = prune_expression(command.expression, probabilities)
+        return None if expression is None else expression_probability(expression, probabilities)
+
+    def new_searcher(self):
+        # Lucene searchers are not shared between Python threads: each retrieval thread gets its own
+        return PyseriniRetriever(self.args.corpus_index_path, use_bm25=True, k1=0.9, b=0.4, cache=self.retrieval_cache)
+
     def retrieve_evidence(self, query):
         hits = self.searcher.retrieve(query, self.args.num_retrieved)
+        return self.build_evidence(query, hits)
+
+    def batch_retrieve_evidence(self, queries, searcher = None):
+        searcher = searcher if searcher is not None else self.searcher
+        qids = [str(i) for i in range(len(queries))]
+        qid_to_hits = searcher.batch_retrieve(queries, qids, self.args.num_retrieved, self.args.retrieval_threads)
+        return [self.build_evidence(query, qid_to_hits[qid]) for query, qid in zip(queries, qids)]
+
+    def build_evidence(self, query, hits):
         evidence = '\n'.join([hit['text'].strip() for hit in hits])
         # cut overlong evidence
         if len(evidence.split()) > self.args.max_evidence_length:
@@ -137,27 +197,33 @@ class Program_Execution:
         
         return evidence, retrieved_results
     
-    def parse_program(self, ID, program, evidence):
+    def parse_program(self, ID, program, evidence, program_ir = None):
+        program_ir = program_ir if program_ir is not None else load_program_ir(program)
         variable_map = {}
+        # probabilities of the Verify answers, when they are scored
+        probabilities = {}
         claim_only = True if self.args.setting == 'close-book' else False
         retrieved_evidence = []
+        final_probability = None
         # for each command
-        for command in program:
-            c_type = self.get_command_type(command)
+        for command in program_ir.commands:
+            c_type = command.c_type
             final_answer = None
             # verify a claim
             if c_type == "VERIFY":
-                return_var, claim = self.parse_verify_command(command, variable_map)
+                return_var, claim = command.target, command.fill(variable_map)
                 # if open-book setting, then retrieve evidence from the corpus
                 if self.args.setting == 'open-book':
                     evidence, retrieved_results = self.retrieve_evidence(claim)
                     retrieved_evidence += retrieved_results
                 
-                answer = self.QA_module.answer_verify_question(claim, evidence, claim_only)['answer_text']
-                variable_map[return_var] = self.map_direct_answer_to_label(answer)
+                answer = self.QA_module.answer_verify_question(claim, evidence, claim_only)
+                variable_map[return_var] = self.map_direct_answer_to_label(answer['answer_text'])
+                if answer.get('probability') is not None:
+                    probabilities[return_var] = answer['probability']
             # ask a question
             elif c_type == "QUESTION":
-                return_var, question = self.parse_question_command(command, variable_map)
+                return_var, question = command.target, command.fill(variable_map)
                 # if open-book setting, then retrieve evidence from the corpus
                 if self.args.setting == 'open-book':
                     evidence, retrieved_results = self.retrieve_evidence(question)
@@ -171,53 +237,381 @@ class Program_Execution:
                 except:
                     print(f"Alert!!! parsing error: {ID}")
                     final_answer = random.sample([True, False], 1)[0]
+                final_probability = self.program_probability(command, probabilities)
         
-        return final_answer, retrieved_evidence
+        return final_answer, final_probability, retrieved_evidence
 
-    def execute_on_dataset(self):
-        # load generated program
-        with open(os.path.join(self.args.program_dir, self.args.program_file_name), 'r') as f:
-            dataset = json.load(f)
-        dataset = dataset if self.args.num_eval_samples < 0 else dataset[:self.args.num_eval_samples]
+    def estimate_call_cost(self, node, evidence):
+        """Estimated number of prompt words of a call. Retrieved evidence is only known 
+        after retrieval, so in the open-book setting it counts as max_evidence_length."""
+        if self.args.setting == 'open-book':
+            evidence_length = self.args.max_evidence_length
+        elif self.args.setting == 'gold':
+            evidence_length = len(evidence.split())
+        else:
+            evidence_length = 0
+        return len(node.argument.split()) + evidence_length
+
+    def next_lazy_chain(self, graph, node_values, evidence):
+        """The calls to execute next in lazy mode: those of the cheapest Predict() operand 
+        that can still change the label (empty once the label is decided)."""
+        chains = graph.needed_chains(node_values)
+        if len(chains) == 0:
+            return []
+        return min(chains, key = lambda chain: sum([self.estimate_call_cost(node, evidence) for node in chain]))
+
+    def answer_call(self, c_type, argument, evidence, claim_only, retrieved_evidence):
+        # if open-book setting, then retrieve evidence from the corpus
+        if self.args.setting == 'open-book':
+            evidence, retrieved_results = self.retrieve_evidence(argument)
+            retrieved_evidence += retrieved_results
+        if c_type == "VERIFY":
+            answer = self.QA_module.answer_verify_question(argument, evidence, claim_only)
+            return self.map_direct_answer_to_label(answer['answer_text']), answer.get('probability')
+        return self.QA_module.answer_question_directly(argument, evidence, claim_only)['answer_text'], None
+
+    def parse_program_lazily(self, ID, program, evidence, program_ir = None):
+        """Execute a program by evaluating its Predict() expression lazily: the calls of the 
+        cheapest undecided operand are executed first, and execution stops as soon as the 
+        label is decided."""
+        program_ir = program_ir if program_ir is not None else load_program_ir(program)
+        graph = compile_program(program, program_ir)
+        if not graph.can_short_circuit:
+            self.execution_stats['calls'] += len(graph.call_nodes)
+            return self.parse_program(ID, program, evidence, program_ir)
 
-        gt_labels, predictions = [], []
-        results = []
-        for sample in tqdm(dataset):
+        claim_only = True if self.args.setting == 'close-book' else False
+        node_values, node_probabilities = {}, {}
+        retrieved_evidence = []
+        chain = self.next_lazy_chain(graph, node_values, evidence)
+        while len(chain) > 0:
+            for node in chain:
+                node_values[node.index], probability = self.answer_call(node.c_type, node.resolve_argument(node_values), evidence, claim_only, retrieved_evidence)
+                if probability is not None:
+                    node_probabilities[node.index] = probability
+            self.execution_stats['calls'] += len(chain)
+            chain = self.next_lazy_chain(graph, node_values, evidence)
+        self.execution_stats['skipped'] += len(graph.call_nodes) - len(node_values)
+
+        try:
+            final_answer = self.derive_final_answer(graph.final_node.ir, graph.final_node.resolve_variables(node_values))
+        except:
+            print(f"Alert!!! parsing error: {ID}")
+            final_answer = random.sample([True, False], 1)[0]
+        final_probability = self.program_probability(graph.final_node.ir, graph.final_node.resolve_variables(node_probabilities))
+        return final_answer, final_probability, retrieved_evidence
+
+    def finish_program(self, state):
+        if state.finished:
+            # the program failed
+            return
+        self.execution_stats['skipped'] += len([node for node in state.graph.call_nodes if node.index not in state.node_values])
+        final_node = state.graph.final_node
+        if final_node is not None:
+            try:
+                state.final_answer = self.derive_final_answer(final_node.ir, final_node.resolve_variables(state.node_values))
+            except:
+                print(f"Alert!!! parsing error: {state.ID}")
+                state.final_answer = random.sample([True, False], 1)[0]
+            state.final_probability = self.program_probability(final_node.ir, final_node.resolve_variables(state.node_probabilities))
+        state.finished = True
+
+    def fail_program(self, state):
+        """A program that cannot be executed votes at random, as in `execute_program`."""
+        print(f"Alert!!! execution error: {state.ID}")
+        state.final_answer = random.sample([True, False], 1)[0]
+        state.finished = True
+
+    def compile_state(self, state):
+        try:
+            state.graph = compile_program(state.program, state.program_ir)
+        except Exception as e:
+            self.fail_program(state)
+
+    def next_nodes(self, state):
+        """The calls of a program that can be executed now (empty once it is done)."""
+        if self.args.lazy_execution and state.graph.can_short_circuit:
+            # one call at a time, the first of its cheapest undecided operand, 
+            # so that its answer can make the others unneeded
+            return self.next_lazy_chain(state.graph, state.node_values, state.evidence)[:1]
+        return state.graph.ready_nodes(state.node_values)
+
+    def execute_step(self, calls, claim_only):
+        """Retrieve the evidence of a step's calls and answer them in batches, then record the answers."""
+        # get evidence for each call
+        if self.args.setting == 'open-book':
+            # if open-book setting, then retrieve evidence for all calls of the step in one batch
+            retrieval_outputs = self.batch_retrieve_evidence([argument for _, _, argument in calls])
+            call_evidences = [evidence for evidence, _ in retrieval_outputs]
+            call_retrieved = [retrieved_results for _, retrieved_results in retrieval_outputs]
+        else:
+            call_evidences = [state.evidence for state, _, _ in calls]
+            call_retrieved = [[] for _ in calls]
+
+        # answer the calls in batches
+        values, probabilities = [None] * len(calls), [None] * len(calls)
+        verify_calls = [i for i, (_, node, _) in enumerate(calls) if node.c_type == "VERIFY"]
+        question_calls = [i for i, (_, node, _) in enumerate(calls) if node.c_type == "QUESTION"]
+        if len(verify_calls) > 0:
+            answers = self.QA_module.batch_answer_verify_question(
+                [calls[i][2] for i in verify_calls], [call_evidences[i] for i in verify_calls], 
+                claim_only, self.args.qa_batch_size, self.args.max_batch_tokens)
+            for i, answer in zip(verify_calls, answers):
+                values[i] = self.map_direct_answer_to_label(answer['answer_text'])
+                probabilities[i] = answer.get('probability')
+        if len(question_calls) > 0:
+            answers = self.QA_module.batch_answer_question_directly(
+                [calls[i][2] for i in question_calls], [call_evidences[i] for i in question_calls], 
+                claim_only, self.args.qa_batch_size, self.args.max_batch_tokens)
+            for i, answer in zip(question_calls, answers):
+                values[i] = answer['answer_text']
+
+        # nothing is recorded before the whole step succeeded, so that it can be retried
+        for (state, node, _), value, probability, retrieved_results in zip(calls, values, probabilities, call_retrieved):
+            state.node_values[node.index] = value
+            if probability is not None:
+                state.node_probabilities[node.index] = probability
+            state.retrieved_evidence += retrieved_results
+
+    def execute_programs_batched(self, states):
+        """Execute programs by their dependency graphs: at each step, the ready Verify/Question 
+        calls of all unfinished programs are answered with batched FLAN-T5 calls, so independent 
+        calls of a program share a step and only dependency chains take several steps.
+        A program that fails votes at random without stopping the others."""
+        claim_only = True if self.args.setting == 'close-book' else False
+        for state in states:
+            self.compile_state(state)
+        
+        active_states = [state for state in states if not state.finished]
+        while len(active_states) > 0:
+            # collect the ready calls of every unfinished program
+            calls, step_states = [], []
+            for state in active_states:
+                try:
+                    ready_nodes = self.next_nodes(state)
+                    state_calls = [(state, node, node.resolve_argument(state.node_values)) for node in ready_nodes]
+                except Exception as e:
+                    self.fail_program(state)
+                    continue
+                if len(ready_nodes) == 0:
+                    self.finish_program(state)
+                    continue
+                calls += state_calls
+                step_states.append(state)
+            self.execution_stats['calls'] += len(calls)
+            self.execution_stats['steps'] += 1 if len(calls) > 0 else 0
+
+            if len(calls) > 0:
+                try:
+                    self.execute_step(calls, claim_only)
+                except Exception as e:
+                    # execute the step program by program, so that only the failing programs fail
+                    for state in step_states:
+                        try:
+                            self.execute_step([call for call in calls if call[0] is state], claim_only)
+                        except Exception as e:
+                            self.fail_program(state)
+
+            active_states = [state for state in step_states if not state.finished]
+
+    def aggregate_predictions(self, sample_predictions):
+        true_count = len([pred for pred in sample_predictions if pred == True])
+        false_count = len([pred for pred in sample_predictions if pred == False])
+        return True if true_count > false_count else False
+
+    def make_result(self, sample, final_prediction, probabilities = None):
+        result = {'id': sample['id'], 
+                  'claim': sample['claim'],
+                  'gold': sample['gold'], 
+                  'prediction': 'supports' if final_prediction == True else 'refutes'}
+        # with --verify_scoring logits: the mean probability of the executed programs' labels being True
+        probabilities = [probability for probability in (probabilities or []) if probability is not None]
+        if len(probabilities) > 0:
+            result['probability'] = sum(probabilities) / len(probabilities)
+        return result
+
+    def get_program_irs(self, sample):
+        """The IR of each program of a sample, as serialized by the generator when it is there."""
+        records = sample.get('program_irs') or [None] * len(sample['predicted_programs'])
+        program_irs = []
+        for program, record in zip(sample['predicted_programs'], records):
+            try:
+                program_irs.append(load_program_ir(program, record))
+            except Exception as e:
+                # programs that cannot even be parsed fail when they are executed
+                program_irs.append(None)
+        return program_irs
+
+    def execute_program(self, ID, program, evidence, program_ir):
+        run_program = self.parse_program_lazily if self.args.lazy_execution else self.parse_program
+        try:
+            single_prediction, probability, retrieved_evidence = run_program(ID, program, evidence, program_ir)
+        except Exception as e:
+            print(f"Alert!!! execution error: {ID}")
+            single_prediction, probability = random.sample([True, False], 1)[0], None
+        return single_prediction, probability
+
+    def print_voting_stats(self):
+        if self.args.adaptive_voting:
+            print(f"Executed {self.execution_stats['executed_programs']} of {self.execution_stats['programs']} programs (adaptive voting).")
+
+    def execute_samples_sequential(self, samples):
+        self.execution_stats = {'calls': 0, 'skipped': 0, 'programs': 0, 'executed_programs': 0}
+        for sample in tqdm(samples):
             program = sample['predicted_programs']
-            gt_labels.append(sample['gold'])
             # get evidence
             evidence = self.gold_evidence_map[sample['id']] if self.args.setting == 'gold' else None
             
             # execute program
-            sample_predictions = []
-            for sample_program in program:
-                try:
-                    single_prediction, retrieved_evidence = self.parse_program(sample['id'], sample_program, evidence)
-                except Exception as e:
-                    print(f"Alert!!! execution error: {sample['id']}")
-                    single_prediction = random.sample([True, False], 1)[0]
-                sample_predictions.append(single_prediction)
-            
-            true_count = len([pred for pred in sample_predictions if pred == True])
-            false_count = len([pred for pred in sample_predictions if pred == False])
-            final_prediction = True if true_count > false_count else False
-            predictions.append('supports' if final_prediction == True else 'refutes')
-            results.append({'id': sample['id'], 
-                            'claim': sample['claim'],
-                            'gold': sample['gold'], 
-                            'prediction': 'supports' if final_prediction == True else 'refutes'})
-        
-        # evaluate
-        self.evaluation(predictions, gt_labels)
+            if self.args.adaptive_voting:
+                vote = Vote_State(program, self.get_program_irs(sample))
+                entries = vote.next_programs()
+                while len(entries) > 0:
+                    outputs = [self.execute_program(sample['id'], sample_program, evidence, program_ir) 
+                               for sample_program, program_ir, _ in entries]
+                    vote.add_votes(entries, [prediction for prediction, _ in outputs], [probability for _, probability in outputs])
+                    self.execution_stats['executed_programs'] += len(entries)
+                    entries = vote.next_programs()
+                self.execution_stats['programs'] += len(program)
+                final_prediction, probabilities = vote.prediction, vote.probabilities
+            else:
+                sample_predictions, probabilities = [], []
+                for sample_program, program_ir in zip(program, self.get_program_irs(sample)):
+                    prediction, probability = self.execute_program(sample['id'], sample_program, evidence, program_ir)
+                    sample_predictions.append(prediction)
+                    probabilities.append(probability)
+                final_prediction = self.aggregate_predictions(sample_predictions)
+            yield self.make_result(sample, final_prediction, probabilities)
+        if self.args.lazy_execution:
+            print(f"Executed {self.execution_stats['calls']} calls, skipped {self.execution_stats['skipped']} calls.")
+        self.print_voting_stats()
+
+    def execute_samples_batched(self, samples):
+        self.execution_stats = {'calls': 0, 'steps': 0, 'skipped': 0, 'programs': 0, 'executed_programs': 0}
+        batch_size = self.args.execution_batch_size
+        chunk = []
+        for sample in tqdm(samples):
+            chunk.append(sample)
+            if len(chunk) == batch_size:
+                yield from self.execute_chunk_batched(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield from self.execute_chunk_batched(chunk)
+        print(f"Executed {self.execution_stats['calls']} calls in {self.execution_stats['steps']} batched steps, skipped {self.execution_stats['skipped']} calls.")
+        self.print_voting_stats()
 
-        # save results to file
+    def execute_chunk_batched(self, chunk):
+        if self.args.adaptive_voting:
+            yield from self.execute_chunk_adaptive(chunk)
+            return
+        # one state per (sample, program)
+        chunk_states = []
+        for sample in chunk:
+            evidence = self.gold_evidence_map[sample['id']] if self.args.setting == 'gold' else None
+            chunk_states.append([Program_State(sample['id'], sample_program, evidence, program_ir) 
+                                 for sample_program, program_ir in zip(sample['predicted_programs'], self.get_program_irs(sample))])
+        self.execute_programs_batched([state for sample_states in chunk_states for state in sample_states])
+
+        for sample, sample_states in zip(chunk, chunk_states):
+            final_prediction = self.aggregate_predictions([state.final_answer for state in sample_states])
+            yield self.make_result(sample, final_prediction, [state.final_probability for state in sample_states])
+
+    def execute_chunk_adaptive(self, chunk):
+        """Batched execution in voting rounds: each round executes, for every undecided 
+        sample, the fewest distinct programs that can decide its vote."""
+        votes = []
+        for sample in chunk:
+            votes.append(Vote_State(sample['predicted_programs'], self.get_program_irs(sample)))
+            self.execution_stats['programs'] += len(sample['predicted_programs'])
+        while True:
+            round_states = []
+            for sample, vote in zip(chunk, votes):
+                entries = vote.next_programs()
+                if len(entries) > 0:
+                    evidence = self.gold_evidence_map[sample['id']] if self.args.setting == 'gold' else None
+                    round_states.append((vote, entries, [Program_State(sample['id'], sample_program, evidence, program_ir) 
+                                                         for sample_program, program_ir, _ in entries]))
+            if len(round_states) == 0:
+                break
+            self.execute_programs_batched([state for _, _, states in round_states for state in states])
+            for vote, entries, states in round_states:
+                vote.add_votes(entries, [state.final_answer for state in states], [state.final_probability for state in states])
+                self.execution_stats['executed_programs'] += len(entries)
+
+        for sample, vote in zip(chunk, votes):
+            yield self.make_result(sample, vote.prediction, vote.probabilities)
+
+    def execute_samples(self, samples):
+        """Execute the programs of each sample and yield its result once it is done."""
+        if self.args.pipeline:
+            pipeline = Execution_Pipeline(self, max_samples = self.args.execution_batch_size, queue_size = self.args.pipeline_queue_size,
+                                          retrieval_workers = self.args.retrieval_workers, retrieval_batch_size = self.args.retrieval_batch_size,
+                                          inference_batch_size = self.args.inference_batch_size)
+            return pipeline.run(samples)
+        if self.args.batch_execution:
+            return self.execute_samples_batched(samples)
+        return self.execute_samples_sequential(samples)
+
+    def load_programs(self):
+        """Iterate over the samples of the program file (JSON list or JSONL)."""
+        samples = iter_json_records(os.path.join(self.args.program_dir, self.args.program_file_name))
+        samples = samples if self.args.num_eval_samples < 0 else itertools.islice(samples, self.args.num_eval_samples)
+        if self.args.num_shards > 1:
+            # round-robin, so that each shard gets claims from the whole file
+            samples = (sample for index, sample in enumerate(samples) if index % self.args.num_shards == self.args.shard_id)
+        return samples
+
+    def get_output_path(self):
         output_path = os.path.join(self.args.output_dir, '{}_{}'.format(self.model_name.split('/')[-1], self.args.setting))
         if not os.path.exists(output_path):
             os.makedirs(output_path)
+        return output_path
+
+    def execute_on_dataset(self):
+        # load generated program
+        samples = self.load_programs()
+
+        if self.args.streaming or self.args.num_shards > 1:
+            results = self.execute_streaming(samples)
+        else:
+            samples = list(samples)
+            results = list(self.execute_samples(samples))
+            # the pipeline yields results as claims finish; keep the order of the program file
+            order = {sample['id']: index for index, sample in enumerate(samples)}
+            results.sort(key = lambda result: order[result['id']])
+        
+        print(f"Answer cache: {self.answer_cache.stats()}")
+        if self.searcher is not None:
+            print(f"Retrieval cache: {self.retrieval_cache.stats()}")
+        # evaluate
+        self.evaluation([result['prediction'] for result in results], [result['gold'] for result in results])
+
+        if not self.args.streaming and self.args.num_shards == 1:
+            # save results to file
+            output_file_name = f'{self.args.dataset_name}.program.json'
+            with open(os.path.join(self.get_output_path(), output_file_name), 'w') as f:
+               f.write(json.dumps(results, indent = 2))
+
+    def execute_streaming(self, samples):
+        """Append each result to a JSONL file as soon as it is done. 
+        Samples already in the file (from an interrupted run) are skipped."""
+        output_file_name = f'{self.args.dataset_name}.program.jsonl'
+        if self.args.num_shards > 1:
+            output_file_name = shard_file_name(output_file_name, self.args.shard_id, self.args.num_shards)
+        output_file = os.path.join(self.get_output_path(), output_file_name)
+        finished_ids = set([result['id'] for result in read_jsonl(output_file)])
+        if len(finished_ids) > 0:
+            print(f"Resuming: {len(finished_ids)} samples already in {output_file}.")
+        samples = (sample for sample in samples if sample['id'] not in finished_ids)
+
+        with open(output_file, 'a') as f:
+            for result in self.execute_samples(samples):
+                append_jsonl(f, [result])
 
-        output_file_name = f'{self.args.dataset_name}.program.json'
-        with open(os.path.join(output_path, output_file_name), 'w') as f:
-           f.write(json.dumps(results, indent = 2))
+        # metrics are computed on the samples of this run from the file
+        results = read_jsonl(output_file)
+        sample_ids = set([sample['id'] for sample in self.load_programs()])
+        return [result for result in results if result['id'] in sample_ids]
 
     def evaluation(self, predictions, gt_labels):
         print_evaluation_results(predictions, gt_labels, num_of_classes=2)
@@ -4,7 +4,13 @@ import json
 from tqdm import tqdm
 
 from prompts import Prompt_Loader
-from utils import OpenAIModel
+from utils import OpenAIModel, Request_Scheduler, FATAL_OPENAI_ERRORS
+from cache import Persistent_Cache
+from io_utils import read_jsonl, append_jsonl
+from program_parser import parse_program, load_program_ir
+
+def text_to_program(generated_text):
+    return [operation.strip() for operation in generated_text.split('\n')]
 
 class Reasoning_Program_Generator:
     def __init__(self, args):
@@ -15,15 +21,107 @@ class Reasoning_Program_Generator:
         self.save_path = args.save_path
         self.num_programs_per_example = args.num_programs_per_example
 
-        self.openai_api = OpenAIModel(args.api_key, args.model_name, args.stop_words, args.max_new_tokens)
-        self.prompt_loader = Prompt_Loader()
+        cache = Persistent_Cache(args.completion_cache_path, table = 'completions') if args.completion_cache_path is not None else None
+        if args.backend == 'openai':
+            scheduler = Request_Scheduler(max_concurrency = args.max_concurrency, 
+                                          requests_per_minute = args.requests_per_minute, 
+                                          tokens_per_minute = args.tokens_per_minute,
+                                          fatal_exceptions = FATAL_OPENAI_ERRORS)
+            self.generator_model = OpenAIModel(args.api_key, args.model_name, args.stop_words, args.max_new_tokens, args.api_base, scheduler, cache)
+            self.prompt_loader = Prompt_Loader(args.model_name)
+        elif args.backend == 'local':
+            from local_model import Local_HF_Model
+            self.generator_model = Local_HF_Model(args.model_name, args.stop_words, args.max_new_tokens, cache, args.cache_dir, 
+                                                  args.local_batch_size, args.device, args.reuse_prefix_kv)
+            self.prompt_loader = Prompt_Loader(args.model_name, self.generator_model.count_tokens)
+        else:
+            raise NotImplementedError(f"Unknown generation backend: {args.backend}")
+
+    def update_results(self, sample, iteration, generated_text):
+        program_list = text_to_program(generated_text)
+        # parse and validate the program once, the executor runs its IR
+        program_ir = parse_program(program_list)
+        if not program_ir.is_valid:
+            print(f"Alert!!! malformed program for example {sample['id']}: {program_ir.errors[0]}")
+        self.generated_programs[(sample['id'], iteration)] = program_list
+        # checkpoint the program as soon as it is generated
+        append_jsonl(self.checkpoint_file, [{'id': sample['id'], 'iteration': iteration, 'predicted_program': program_list, 
+                                             'program_ir': program_ir.to_dict()}])
+
+    def build_prompt(self, claim):
+        return self.prompt_loader.prompt_construction(claim, self.dataset_name, 
+                                                      self.args.prompt_token_budget, self.args.num_demonstrations)
+
+    def generate_per_iteration(self, raw_dataset, temperature):
+        # one request per missing (sample, iteration), all handed to the request scheduler at once
+        requests = [(sample, iteration) for iteration in range(self.num_programs_per_example) for sample in raw_dataset
+                    if (sample['id'], iteration) not in self.generated_programs]
+        print(f"Generating {len(requests)} programs...")
+        full_prompts = [self.build_prompt(sample['claim']) for sample, _ in requests]
+        progress_bar = tqdm(total = len(requests))
+
+        def on_result(index, output):
+            sample, iteration = requests[index]
+            if output is None:
+                print('Error in generating reasoning programs for example: ', sample['id'])
+            else:
+                self.update_results(sample, iteration, output)
+            progress_bar.update(1)
+
+        self.generator_model.batch_generate(full_prompts, temperature, on_result, [iteration for _, iteration in requests])
+        progress_bar.close()
+
+    def generate_with_n_sampling(self, raw_dataset, temperature):
+        # one request per sample asking for all its programs (the `n` parameter)
+        raw_dataset = [sample for sample in raw_dataset 
+                       if any([(sample['id'], iteration) not in self.generated_programs for iteration in range(self.num_programs_per_example)])]
+        print(f"Generating {self.num_programs_per_example} programs for each of {len(raw_dataset)} examples...")
+        full_prompts = [self.build_prompt(sample['claim']) for sample in raw_dataset]
+        progress_bar = tqdm(total = len(raw_dataset))
 
-    def update_results(self, sample, generated_text):
-        program_list = [operation.strip() for operation in generated_text.split('\n')]
-        # programs = [program_list]
-        self.result_dict[sample['id']]['predicted_programs'].append(program_list)
+        def on_result(index, outputs):
+            sample = raw_dataset[index]
+            for iteration, output in enumerate(outputs):
+                if (sample['id'], iteration) in self.generated_programs:
+                    continue
+                if output is None:
+                    print('Error in generating reasoning programs for example: ', sample['id'])
+                else:
+                    self.update_results(sample, iteration, output)
+            progress_bar.update(1)
 
-    def batch_generate_programs(self, batch_size = 10):
+        self.generator_model.batch_generate_samples(full_prompts, self.num_programs_per_example, temperature, on_result)
+        progress_bar.close()
+
+    def generate_programs(self, claims):
+        """Generate the programs of a list of claims in one batch, without checkpoints (used by the fact-checking service).
+
+        Returns, for each claim, the list of its programs; failed generations are left out.
+        """
+        temperature = 0.0 if self.num_programs_per_example == 1 else 0.7
+        full_prompts = [self.build_prompt(claim) for claim in claims]
+        if self.args.use_n_sampling and self.num_programs_per_example > 1:
+            outputs = self.generator_model.batch_generate_samples(full_prompts, self.num_programs_per_example, temperature)
+        else:
+            requests = [(index, iteration) for iteration in range(self.num_programs_per_example) for index in range(len(claims))]
+            generated_texts = self.generator_model.batch_generate([full_prompts[index] for index, _ in requests], temperature, 
+                                                                  sample_indices = [iteration for _, iteration in requests])
+            outputs = [[] for _ in claims]
+            for (index, _), generated_text in zip(requests, generated_texts):
+                outputs[index].append(generated_text)
+        return [[text_to_program(generated_text) for generated_text in generated_texts if generated_text is not None] 
+                for generated_texts in outputs]
+
+    def load_checkpoint(self, checkpoint_path):
+        generated_programs = {}
+        self.program_irs = {}
+        for record in read_jsonl(checkpoint_path):
+            if record['id'] in self.result_dict:
+                generated_programs[(record['id'], record['iteration'])] = record['predicted_program']
+                self.program_irs[(record['id'], record['iteration'])] = load_program_ir(record['predicted_program'], record.get('program_ir'))
+        return generated_programs
+
+    def batch_generate_programs(self):
         # create output_dir
         self.result_dict = []
         if not os.path.exists(self.save_path):
@@ -39,8 +137,6 @@ class Reasoning_Program_Generator:
         # generate programs
         temperature = 0.0 if self.num_programs_per_example == 1 else 0.7
         outputs = []
-        # split dataset into chunks
-        dataset_chunks = [raw_dataset[i:i + batch_size] for i in range(0, len(raw_dataset), batch_size)]
         
         # initialize empty results
         result_dict = {}
@@ -49,42 +145,44 @@ class Reasoning_Program_Generator:
                         'id': sample['id'], 
                         'claim': sample['claim'],
                         'gold': sample['label'], 
-                        'predicted_programs': []}
+                        'predicted_programs': [],
+                        'program_irs': []}
             result_dict[sample['id']] = result
         self.result_dict = result_dict
 
-        # for each iteration
-        for iteration in range(self.num_programs_per_example):
-            print(f"Generating programs for iteration {iteration + 1}...")
-            # for each chunk
-            for chunk in tqdm(dataset_chunks):
-                # create prompt
-                full_prompts = [self.prompt_loader.prompt_construction(example['claim'], self.dataset_name) for example in chunk]
-                try:
-                    batch_outputs = self.openai_api.batch_generate(full_prompts, temperature)
-                    # create output
-                    for sample, output in zip(chunk, batch_outputs):
-                        self.update_results(sample, output)
-                except:
-                    # generate one by one if batch generation fails
-                    for sample, full_prompt in zip(chunk, full_prompts):
-                        try:
-                            output = self.openai_api.generate(full_prompt, temperature)
-                            self.update_results(sample, output)
-                        except:
-                            print('Error in generating reasoning programs for example: ', sample['id'])
+        # resume from the programs checkpointed by an interrupted run
+        output_file = os.path.join(self.save_path, f'{self.dataset_name}_N={self.num_programs_per_example}_{self.model_name.split("/")[-1]}_programs.json')
+        checkpoint_path = os.path.splitext(output_file)[0] + '.checkpoint.jsonl'
+        self.generated_programs = self.load_checkpoint(checkpoint_path)
+        if len(self.generated_programs) > 0:
+            print(f"Resuming: {len(self.generated_programs)} programs already in {checkpoint_path}.")
+
+        with open(checkpoint_path, 'a') as self.checkpoint_file:
+            if self.args.use_n_sampling and self.num_programs_per_example > 1:
+                self.generate_with_n_sampling(raw_dataset, temperature)
+            else:
+                self.generate_per_iteration(raw_dataset, temperature)
 
         print(f"Generated {len(result_dict)} examples.")
-        # create outputs
+        if getattr(self.generator_model, 'prefix_cache', None) is not None:
+            print(f"Prefix key/value cache: {self.generator_model.prefix_cache.stats()}")
+        # create outputs from the checkpoint
+        self.generated_programs = self.load_checkpoint(checkpoint_path)
         for key in result_dict:
+            for iteration in range(self.num_programs_per_example):
+                if (key, iteration) in self.generated_programs:
+                    result_dict[key]['predicted_programs'].append(self.generated_programs[(key, iteration)])
+                    result_dict[key]['program_irs'].append(self.program_irs[(key, iteration)].to_dict())
             outputs.append(result_dict[key])
+        num_invalid = len([program_ir for program_ir in self.program_irs.values() if not program_ir.is_valid])
+        print(f"{num_invalid} of {len(self.program_irs)} programs are malformed (see the errors of their IR).")
         sorted_outputs = sorted(outputs, key=lambda x: x['idx'])
 
         # save outputs
-        with open(os.path.join(self.save_path, f'{self.dataset_name}_N={self.num_programs_per_example}_{self.model_name}_programs.json'), 'w') as f:
+        with open(output_file, 'w') as f:
             json.dump(sorted_outputs, f, indent=2, ensure_ascii=False)
 
-def parse_args():
+def parse_args(argv = None):
     parser = argparse.ArgumentParser()
     # dataset args
     parser.add_argument('--dataset_name', default='HOVER', type=str)
@@ -96,7 +194,23 @@ def parse_args():
     parser.add_argument('--model_name', type=str, default='text-davinci-003')
     parser.add_argument('--stop_words', type=str, default='# The claim is')
     parser.add_argument('--max_new_tokens', type=int, default=1024)
-    args = parser.parse_args()
+    # backend args
+    parser.add_argument('--backend', type=str, default='openai', help='[openai | local]; local runs the Hugging Face model --model_name')
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--local_batch_size', type=int, default=4, help='prompts encoded together by the local model')
+    parser.add_argument('--reuse_prefix_kv', action='store_true', help='compute the key/values of the shared demonstrations once (causal models)')
+    # prompt args
+    parser.add_argument('--prompt_token_budget', type=int, default=None, help='maximum number of prompt tokens; the most similar demonstrations that fit are kept')
+    parser.add_argument('--num_demonstrations', type=int, default=None, help='number of most similar demonstrations to keep')
+    # request scheduling args
+    parser.add_argument('--api_base', type=str, default=None, help='e.g. http://localhost:8000/v1 for mock_openai_server.py')
+    parser.add_argument('--max_concurrency', type=int, default=8, help='maximum number of requests in flight')
+    parser.add_argument('--requests_per_minute', type=int, default=None)
+    parser.add_argument('--tokens_per_minute', type=int, default=None)
+    parser.add_argument('--use_n_sampling', action='store_true', help='request all programs of a claim in one request with the `n` parameter')
+    parser.add_argument('--completion_cache_path', type=str, default=None, help='sqlite file caching completions across runs')
+    args = parser.parse_args(argv)
     return args
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+import re
+
+# patterns are compiled once, not for every command
+VERIFY_PATTERN = re.compile(r'Verify\([f]?\"(.*)\"\)', re.S)
+QUESTION_PATTERN = re.compile(r'Question\([f]?\"(.*)\"\)', re.S)
+PREDICT_PATTERN = re.compile(r'Predict\((.*)\)', re.S)
+# non-greedy capture of the original parser, for text after Predict() containing `)`
+PREDICT_FALLBACK_PATTERN = re.compile(r'Predict[(](.*?)[)]', re.S)
+VARIABLE_PATTERN = re.compile(r'\{(\w+)\}')
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_]\w*')
+EXPRESSION_TOKEN_PATTERN = re.compile(r'\s*(?:([()])|([A-Za-z_]\w*))')
+OPERATORS = {'and', 'or', 'not'}
+
+# bumped when the serialized IR changes, so that older IRs are parsed again
+IR_VERSION = 2
+
+class Program_Syntax_Error(Exception):
+    pass
+
+def get_command_type(command):
+    if command.find("label = ")>=0:
+        return "FINAL"
+    elif command.find('= Verify')>=0:
+        return "VERIFY"
+    elif command.find('= Question')>=0:
+        return "QUESTION"
+    else:
+        return "UNKNOWN"
+
+def parse_call_command(command, c_type):
+    if c_type == "VERIFY":
+        return_var, tmp = command.split('= Verify', 1)
+        matching = re.findall(VERIFY_PATTERN, command)
+    else:
+        return_var, tmp = command.split('= Question', 1)
+        matching = re.findall(QUESTION_PATTERN, command)
+    argument = matching[0] if len(matching)>0 else tmp
+    return return_var.strip(), argument
+
+def tokenize_expression(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = EXPRESSION_TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise Program_Syntax_Error(f"unexpected character {text[position:].strip()[:1]!r} in Predict({text})")
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    return tokens
+
+def parse_expression(text):
+    """Parse the argument of Predict() into an expression tree.
+
+    Trees are JSON-friendly lists: ['var', name], ['not', operand], and
+    ['and', operand, ...] / ['or', operand, ...] with `not` binding tighter
+    than `and`, and `and` tighter than `or`.
+    """
+    tokens = tokenize_expression(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise Program_Syntax_Error(f"unexpected end of Predict({text})")
+        position += 1
+        return token
+
+    def parse_binary(operator, parse_operand):
+        operands = [parse_operand()]
+        while peek() == operator:
+            take()
+            operands.append(parse_operand())
+        return operands[0] if len(operands) == 1 else [operator] + operands
+
+    def parse_or():
+        return parse_binary('or', parse_and)
+
+    def parse_and():
+        return parse_binary('and', parse_not)
+
+    def parse_not():
+        if peek() == 'not':
+            take()
+            return ['not', parse_not()]
+        return parse_atom()
+
+    def parse_atom():
+        token = take()
+        if token == '(':
+            expression = parse_or()
+            if take() != ')':
+                raise Program_Syntax_Error(f"unbalanced parentheses in Predict({text})")
+            return expression
+        if token == ')' or token in OPERATORS:
+            raise Program_Syntax_Error(f"unexpected {token!r} in Predict({text})")
+        return ['var', token]
+
+    expression = parse_or()
+    if peek() is not None:
+        raise Program_Syntax_Error(f"unexpected {peek()!r} in Predict({text})")
+    return expression
+
+def expression_variables(expression):
+    """Variables of an expression tree, in order of appearance."""
+    if expression[0] == 'var':
+        return [expression[1]]
+    variables = []
+    for operand in expression[1:]:
+        variables += [name for name in expression_variables(operand) if name not in variables]
+    return variables
+
+class Program_Command:
+    """Typed IR of one program command.
+
+    Verify/Question calls keep their target variable, their argument template
+    and the variables filling its `{slots}`; the Predict command keeps its raw
+    argument and its expression tree (None when the argument does not parse).
+    """
+    def __init__(self, c_type, text = '', target = None, template = None, slots = None, argument = None, expression = None) -> None:
+        self.c_type = c_type
+        self.text = text
+        self.target = target
+        self.template = template
+        self.slots = slots if slots is not None else []
+        self.argument = argument
+        self.expression = expression
+
+    def fill(self, variable_map):
+        """The argument of a call with its slots replaced by the values in `variable_map`."""
+        argument = self.template
+        for name in self.slots:
+            if name in variable_map:
+                argument = argument.replace("{" + name + "}", str(variable_map[name]))
+        return argument
+
+    @property
+    def variables(self):
+        """Variables read by the command."""
+        if self.c_type == "FINAL":
+            if self.expression is not None:
+                return expression_variables(self.expression)
+            return [name for name in IDENTIFIER_PATTERN.findall(self.argument or '') if name not in OPERATORS]
+        return list(self.slots)
+
+    def to_dict(self):
+        if self.c_type in ["VERIFY", "QUESTION"]:
+            return {'type': self.c_type, 'target': self.target, 'template': self.template, 'slots': self.slots}
+        elif self.c_type == "FINAL":
+            return {'type': self.c_type, 'argument': self.argument, 'expression': self.expression}
+        return {'type': self.c_type}
+
+    @classmethod
+    def from_dict(cls, record, text = ''):
+        return cls(record['type'], text, record.get('target'), record.get('template'), record.get('slots'),
+                   record.get('argument'), record.get('expression'))
+
+class Program_IR:
+    """A reasoning program parsed once into typed commands, with the problems found while validating it."""
+    def __init__(self, commands, errors = None) -> None:
+        self.commands = commands
+        self.errors = errors if errors is not None else []
+
+    @property
+    def is_valid(self):
+        return len(self.errors) == 0
+
+    def to_dict(self):
+        return {'version': IR_VERSION, 'commands': [command.to_dict() for command in self.commands], 'errors': self.errors}
+
+    @classmethod
+    def from_dict(cls, record, program = None):
+        program = program if program is not None else [''] * len(record['commands'])
+        commands = [Program_Command.from_dict(command, text) for command, text in zip(record['commands'], program)]
+        return cls(commands, record.get('errors', []))
+
+def parse_command(command):
+    c_type = get_command_type(command)
+    if c_type in ["VERIFY", "QUESTION"]:
+        target, template = parse_call_command(command, c_type)
+        return Program_Command(c_type, command, target, template, VARIABLE_PATTERN.findall(template))
+    elif c_type == "FINAL":
+        text = command.replace('label =', '').strip()
+        matching = re.findall(PREDICT_PATTERN, text)
+        if len(matching) == 0:
+            return Program_Command(c_type, command)
+        # the greedy capture keeps nested parentheses; when it does not parse, the
+        # non-greedy one is tried, and kept for the " and " split of the executor
+        for argument in [matching[0], re.findall(PREDICT_FALLBACK_PATTERN, text)[0]]:
+            try:
+                return Program_Command(c_type, command, argument = argument, expression = parse_expression(argument))
+            except Program_Syntax_Error:
+                pass
+        return Program_Command(c_type, command, argument = argument)
+    return Program_Command(c_type, command)
+
+def parse_program(program):
+    """Parse a list of program commands into a Program_IR and validate it."""
+    commands = []
+    errors = []
+    defined = set()
+    for index, text in enumerate(program):
+        command = parse_command(text)
+        if command.c_type in ["VERIFY", "QUESTION"]:
+            if IDENTIFIER_PATTERN.fullmatch(command.target) is None:
+                errors.append(f"line {index}: invalid variable name {command.target!r}")
+            for name in command.slots:
+                if name not in defined:
+                    errors.append(f"line {index}: undefined variable {name!r}")
+            defined.add(command.target)
+        elif command.c_type == "FINAL":
+            if command.argument is None:
+                errors.append(f"line {index}: label is not assigned with Predict()")
+            elif command.expression is None:
+                try:
+                    parse_expression(command.argument)
+                except Program_Syntax_Error as e:
+                    errors.append(f"line {index}: {e}")
+            else:
+                for name in command.variables:
+                    if name not in defined:
+                        errors.append(f"line {index}: undefined variable {name!r}")
+        elif text.strip() != '':
+            errors.append(f"line {index}: unknown command {text.strip()!r}")
+        commands.append(command)
+
+    if len(commands) == 0 or commands[-1].c_type != "FINAL":
+        errors.append("program does not end with Predict()")
+    return Program_IR(commands, errors)
+
+def load_program_ir(program, record = None):
+    """The IR of a program: from its serialized `record` when it is up to date, else parsed again."""
+    if record is not None and record.get('version') == IR_VERSION and len(record['commands']) == len(program):
+        return Program_IR.from_dict(record, program)
+    return parse_program(program)
@@ -1,3 +1,7 @@
+import re
+import math
+from collections import Counter
+
 HOVER_PROGRAM_FC = ''''Generate a python-like program that describes the reasoning steps required to verify the claim step-by-step. You can call three functions in the program: 1. Question() to answer a question; 2. Verify() to verify a simple claim; 3. Predict() to predict the veracity label. Several examples are given as follows.
 
 # The claim is that Howard University Hospital and Providence Hospital are both located in Washington, D.C.
@@ -216,18 +220,105 @@ def program():
 def program():'''
 
 
+DEMONSTRATION_SEPARATOR = '\n# The claim is that '
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def approximate_num_tokens(text):
+    # words and punctuation marks, about the count of BPE tokenizers on English text
+    return int(len(TOKEN_PATTERN.findall(text)) * 1.3) + 1
+
+class Demonstration_Index:
+    """Demonstrations of a few-shot template, with their token counts and a lexical index.
+
+    The template is split into its instruction, its demonstrations and the 
+    final `[[CLAIM]]` query. Demonstrations are ranked by the IDF-weighted 
+    cosine similarity of their claim to the claim to verify.
+    """
+    def __init__(self, template, count_tokens) -> None:
+        parts = template.split(DEMONSTRATION_SEPARATOR)
+        self.instruction = parts[0]
+        self.demonstrations = parts[1:-1]
+        self.query = parts[-1]
+        self.count_tokens = count_tokens
+        # token counts are computed once
+        self.instruction_tokens = count_tokens(self.instruction + DEMONSTRATION_SEPARATOR + self.query)
+        self.demonstration_tokens = [count_tokens(DEMONSTRATION_SEPARATOR + demonstration) for demonstration in self.demonstrations]
+
+        claim_words = [self.tokenize(demonstration.split('\n')[0]) for demonstration in self.demonstrations]
+        document_frequency = Counter([word for words in claim_words for word in set(words)])
+        self.idf = {word: math.log((1 + len(claim_words)) / (1 + count)) + 1 for word, count in document_frequency.items()}
+        self.default_idf = math.log(1 + len(claim_words)) + 1
+        self.demonstration_vectors = [self.vectorize(words) for words in claim_words]
+
+    def tokenize(self, text):
+        return re.findall(r'\w+', text.lower())
+
+    def vectorize(self, words):
+        vector = {word: count * self.idf.get(word, self.default_idf) for word, count in Counter(words).items()}
+        norm = math.sqrt(sum([value * value for value in vector.values()])) or 1.0
+        return {word: value / norm for word, value in vector.items()}
+
+    def rank(self, claim):
+        claim_vector = self.vectorize(self.tokenize(claim))
+        scores = [sum([value * demonstration_vector.get(word, 0.0) for word, value in claim_vector.items()]) 
+                  for demonstration_vector in self.demonstration_vectors]
+        return sorted(range(len(self.demonstrations)), key=lambda i: -scores[i])
+
+    def build_prompt(self, claim, token_budget = None, num_demonstrations = None):
+        """Prompt with the most similar demonstrations that fit in `token_budget` tokens
+        (at most `num_demonstrations` of them), kept in their original order."""
+        budget = None if token_budget is None else token_budget - self.instruction_tokens - self.count_tokens(claim)
+        selected = []
+        for i in self.rank(claim):
+            if num_demonstrations is not None and len(selected) >= num_demonstrations:
+                break
+            if budget is not None:
+                if self.demonstration_tokens[i] > budget:
+                    continue
+                budget -= self.demonstration_tokens[i]
+            selected.append(i)
+        demonstrations = [self.demonstrations[i] for i in sorted(selected)]
+        template = DEMONSTRATION_SEPARATOR.join([self.instruction] + demonstrations + [self.query])
+        return template.replace('[[CLAIM]]', claim)
+
 class Prompt_Loader:
-    def __init__(self) -> None:
+    def __init__(self, model_name = None, count_tokens = None) -> None:
         self.hover_program_fc = HOVER_PROGRAM_FC
         self.feverous_program_fc = FEVEROUS_PROGRAM_FC
+        self.model_name = model_name
+        self.count_tokens = count_tokens
+        self.demonstration_indexes = {}
 
-    def prompt_construction(self, claim, dataset_name):
-        template = None
+    def get_template(self, dataset_name):
         if dataset_name == 'HOVER':
-            template = self.hover_program_fc
+            return self.hover_program_fc
         elif dataset_name == 'FEVEROUS':
-            template = self.feverous_program_fc
+            return self.feverous_program_fc
         else:
             raise NotImplementedError
-        
-        return template.replace('[[CLAIM]]', claim)
\ No newline at end of file
+
+    def get_token_counter(self):
+        if self.count_tokens is not None:
+            return self.count_tokens
+        # exact counts with tiktoken when it is installed
+        try:
+            import tiktoken
+        except ImportError:
+            return approximate_num_tokens
+        try:
+            encoding = tiktoken.encoding_for_model(self.model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text))
+
+    def get_demonstration_index(self, dataset_name):
+        if dataset_name not in self.demonstration_indexes:
+            self.demonstration_indexes[dataset_name] = Demonstration_Index(self.get_template(dataset_name), self.get_token_counter())
+        return self.demonstration_indexes[dataset_name]
+
+    def prompt_construction(self, claim, dataset_name, token_budget = None, num_demonstrations = None):
+        if token_budget is not None or num_demonstrations is not None:
+            return self.get_demonstration_index(dataset_name).build_prompt(claim, token_budget, num_demonstrations)
+
+        template = self.get_template(dataset_name)
+        return template.replace('[[CLAIM]]', claim)
@@ -1,18 +1,160 @@
 import argparse
 import torch
+from collections import OrderedDict
+from transformers.modeling_outputs import BaseModelOutput
+
+from cache import hash_key
+
+# prompt templates of the sub-task handlers
+EVIDENCE_PREFIX = "{evidence}\n"
+QUESTION_CLAIM_ONLY_TEMPLATE = "Question: {question}\nThe answer is:"
+QUESTION_TEMPLATE = EVIDENCE_PREFIX + QUESTION_CLAIM_ONLY_TEMPLATE
+VERIFY_EVIDENCE_SUFFIX = "Based on the above information, is it true that {claim}? True or false? The answer is: "
+VERIFY_TEMPLATE = EVIDENCE_PREFIX + VERIFY_EVIDENCE_SUFFIX
+VERIFY_CLAIM_ONLY_TEMPLATE = "Is it true that {claim}? True or false? The answer is: "
+# first-step answer tokens scored by the `logits` verify scoring; sentencepiece
+# has separate ids for the capitalised words, which the model also answers with
+LABEL_WORDS = {True: ['true', 'yes', 'True', 'Yes'], False: ['false', 'no', 'False', 'No']}
 
 class T5_Question_Answering:
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, model_name = None, cache = None, shared_evidence_encoding = False, evidence_cache_size = 16, device = None, verify_scoring = 'generate'):
         self.model = model
         self.tokenizer = tokenizer
+        # device of the model inputs, given by the inference backend
+        self.device = device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu")
+        # answers are memoized in `cache` (a Persistent_Cache) when it is given
+        self.model_name = model_name
+        self.cache = cache
+        # answers also depend on the model class, its weights revision and the tokenizer
+        config = getattr(model, 'config', None)
+        self.model_key = [model_name, type(model).__name__, getattr(config, '_commit_hash', None),
+                          type(tokenizer).__name__, getattr(tokenizer, 'name_or_path', None)]
+        # encode each evidence block once and reuse its encoder states for all questions on it
+        self.shared_evidence_encoding = shared_evidence_encoding
+        self.evidence_cache_size = evidence_cache_size
+        self.evidence_states = OrderedDict()
+        # [generate | logits]: how Verify calls are answered
+        self.verify_scoring = verify_scoring
+        self.label_token_ids = None
 
     def generate(self, input_string, **generator_args):
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        input_ids = self.tokenizer.encode(input_string, return_tensors="pt").to(device)
+        input_ids = self.tokenizer.encode(input_string, return_tensors="pt").to(self.device)
         with torch.no_grad():
             res = self.model.generate(input_ids, **generator_args)
         return self.tokenizer.batch_decode(res, skip_special_tokens=True)
 
+    def length_buckets(self, lengths, max_batch_tokens, max_batch_size):
+        """Group the indices of inputs of token lengths `lengths` into length-sorted batches."""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches, current_batch = [], []
+        for i in order:
+            # inputs come in increasing length, so input i is the longest of its batch
+            padded_size = lengths[i] * (len(current_batch) + 1)
+            if len(current_batch) > 0 and (padded_size > max_batch_tokens or len(current_batch) >= max_batch_size):
+                batches.append(current_batch)
+                current_batch = []
+            current_batch.append(i)
+        if len(current_batch) > 0:
+            batches.append(current_batch)
+        return batches
+
+    def generate_many(self, input_strings, max_batch_tokens = 16384, max_batch_size = 64, **generator_args):
+        """Batched generation with length bucketing and dynamic padding.
+
+        Inputs are sorted by token length and cut into batches whose padded 
+        size (batch size x longest input) stays within `max_batch_tokens`, 
+        so each batch is only padded to its own longest input. Outputs are 
+        returned in the order of `input_strings`.
+        """
+        encoded = self.tokenizer(input_strings)['input_ids']
+        batches = self.length_buckets([len(ids) for ids in encoded], max_batch_tokens, max_batch_size)
+
+        outputs = [None] * len(input_strings)
+        for batch in batches:
+            inputs = self.tokenizer.pad({'input_ids': [encoded[i] for i in batch]}, return_tensors="pt").to(self.device)
+            with torch.no_grad():
+                res = self.model.generate(**inputs, **generator_args)
+            for i, output in zip(batch, self.tokenizer.batch_decode(res, skip_special_tokens=True)):
+                outputs[i] = output
+        return outputs
+
+    def get_label_token_ids(self):
+        if self.label_token_ids is None:
+            # each id is scored once, for the first label it is found in
+            self.label_token_ids = {}
+            seen = set()
+            for label, words in LABEL_WORDS.items():
+                ids = [self.tokenizer(word, add_special_tokens=False).input_ids[0] for word in words]
+                self.label_token_ids[label] = [token_id for token_id in dict.fromkeys(ids) if token_id not in seen]
+                seen.update(self.label_token_ids[label])
+        return self.label_token_ids
+
+    def score_labels_many(self, input_strings, max_batch_tokens = 16384, max_batch_size = 64):
+        """Probability that each true-or-false prompt is answered True.
+
+        Instead of decoding, a single decoder step is run and the logits of the 
+        label tokens ("true"/"yes" vs. "false"/"no", in both cases) are compared, 
+        normalized over the label tokens only, and summed per label.
+        """
+        label_token_ids = self.get_label_token_ids()
+        true_ids, false_ids = label_token_ids[True], label_token_ids[False]
+        encoded = self.tokenizer(input_strings)['input_ids']
+        batches = self.length_buckets([len(ids) for ids in encoded], max_batch_tokens, max_batch_size)
+
+        probabilities = [None] * len(input_strings)
+        for batch in batches:
+            inputs = self.tokenizer.pad({'input_ids': [encoded[i] for i in batch]}, return_tensors="pt").to(self.device)
+            decoder_input_ids = torch.full((len(batch), 1), self.model.config.decoder_start_token_id, dtype=torch.long, device=self.device)
+            with torch.no_grad():
+                logits = self.model(**inputs, decoder_input_ids=decoder_input_ids).logits[:, 0, :].float()
+            label_log_probs = torch.log_softmax(logits[:, true_ids + false_ids], dim=-1)
+            true_probs = label_log_probs[:, :len(true_ids)].exp().sum(dim=-1)
+            for i, prob in zip(batch, true_probs.tolist()):
+                probabilities[i] = prob
+        return probabilities
+
+    def encode_evidence(self, evidence):
+        """Encoder states of `EVIDENCE_PREFIX` filled with `evidence`, kept in a small LRU."""
+        if evidence in self.evidence_states:
+            self.evidence_states.move_to_end(evidence)
+            return self.evidence_states[evidence]
+        input_ids = self.tokenizer(EVIDENCE_PREFIX.format(evidence = evidence), add_special_tokens=False, return_tensors="pt").input_ids.to(self.device)
+        with torch.no_grad():
+            states = self.model.get_encoder()(input_ids=input_ids).last_hidden_state
+        self.evidence_states[evidence] = states
+        while len(self.evidence_states) > self.evidence_cache_size:
+            self.evidence_states.popitem(last = False)
+        return states
+
+    def generate_with_shared_evidence(self, evidence, input_strings, max_batch_tokens = 16384, max_batch_size = 64, **generator_args):
+        """Answer several prompts on the same evidence, fusion-in-decoder style.
+
+        The evidence is encoded once; each prompt (without the evidence) is 
+        encoded separately and the decoder attends to the concatenation of 
+        both encoder states. This approximates encoding the full prompt, as 
+        the evidence and the question no longer attend to each other. Batches 
+        are bucketed as in `generate_many`, each input counting the evidence 
+        tokens the decoder attends to.
+        """
+        evidence_states = self.encode_evidence(evidence)
+        encoded = self.tokenizer(input_strings)['input_ids']
+        batches = self.length_buckets([evidence_states.shape[1] + len(ids) for ids in encoded], max_batch_tokens, max_batch_size)
+
+        outputs = [None] * len(input_strings)
+        for batch in batches:
+            inputs = self.tokenizer.pad({'input_ids': [encoded[i] for i in batch]}, return_tensors="pt").to(self.device)
+            with torch.no_grad():
+                question_states = self.model.get_encoder()(**inputs).last_hidden_state
+                batch_evidence_states = evidence_states.to(question_states.device).expand(len(batch), -1, -1)
+                encoder_states = torch.cat([batch_evidence_states, question_states], dim=1)
+                evidence_mask = torch.ones(batch_evidence_states.shape[:2], dtype=inputs.attention_mask.dtype, device=inputs.attention_mask.device)
+                attention_mask = torch.cat([evidence_mask, inputs.attention_mask], dim=1)
+                res = self.model.generate(encoder_outputs=BaseModelOutput(last_hidden_state=encoder_states), 
+                                          attention_mask=attention_mask, **generator_args)
+            for i, output in zip(batch, self.tokenizer.batch_decode(res, skip_special_tokens=True)):
+                outputs[i] = output
+        return outputs
+
     def get_answer_from_rationale(self, rationale):
         # method 1: string matching
         indicators = ['final answer:', 'the answer is', 'the final answer is']
@@ -67,38 +209,126 @@ class T5_Question_Answering:
 
         return predict_answer
 
-    def answer_question_directly(self, question, evidence, claim_only = False):
+    def question_prompt(self, question, evidence, claim_only = False):
         if claim_only == True:
-            example = f"Question: {question}\nThe answer is:"
-        else:
-            example = f"{evidence}\nQuestion: {question}\nThe answer is:"
+            return QUESTION_CLAIM_ONLY_TEMPLATE, {'question': question}
+        return QUESTION_TEMPLATE, {'evidence': evidence, 'question': question}
 
+    def verify_prompt(self, claim, evidence, claim_only = False):
+        claim = claim[:-1] if claim.endswith('.') else claim
+        if claim_only == True:
+            return VERIFY_CLAIM_ONLY_TEMPLATE, {'claim': claim}
+        return VERIFY_TEMPLATE, {'evidence': evidence, 'claim': claim}
+
+    def cache_key(self, template, fields, generator_args):
+        if self.shared_evidence_encoding:
+            # answers differ from the ones of the jointly encoded prompt
+            return hash_key(self.model_key, template, fields, generator_args, 'shared_evidence_encoding')
+        return hash_key(self.model_key, template, fields, generator_args)
+
+    def generate_from_prompts(self, prompts, batch_size = 1, max_batch_tokens = 16384, **generator_args):
+        """Generate answers for a list of (template, fields) prompts.
+
+        Answers found in the cache are reused, and identical prompts are 
+        generated only once.
+        """
+        keys = [self.cache_key(template, fields, generator_args) for template, fields in prompts]
+        answers = {}
+        if self.cache is not None:
+            for key in set(keys):
+                cached_answer = self.cache.get(key)
+                if cached_answer is not None:
+                    answers[key] = cached_answer
+
+        missing_examples = {}
+        shared_evidence_examples = {}
+        for key, (template, fields) in zip(keys, prompts):
+            if key in answers or key in missing_examples:
+                continue
+            if self.shared_evidence_encoding and template.startswith(EVIDENCE_PREFIX):
+                question_template = template[len(EVIDENCE_PREFIX):]
+                shared_evidence_examples.setdefault(fields['evidence'], {})[key] = question_template.format(**fields)
+            else:
+                missing_examples[key] = template.format(**fields)
+
+        new_answers = []
+        if len(missing_examples) > 0:
+            outputs = self.generate_many(list(missing_examples.values()), max_batch_tokens, batch_size, **generator_args)
+            new_answers += [(key, output.strip()) for key, output in zip(missing_examples, outputs)]
+        for evidence, examples in shared_evidence_examples.items():
+            outputs = self.generate_with_shared_evidence(evidence, list(examples.values()), max_batch_tokens, batch_size, **generator_args)
+            new_answers += [(key, output.strip()) for key, output in zip(examples, outputs)]
+        if len(new_answers) > 0:
+            answers.update(new_answers)
+            if self.cache is not None:
+                self.cache.set_many(new_answers)
+        return [answers[key] for key in keys]
+
+    def score_from_prompts(self, prompts, batch_size = 1, max_batch_tokens = 16384):
+        """Probability of True for a list of Verify (template, fields) prompts, with caching."""
+        keys = [hash_key(self.model_key, template, fields, 'label_logits', LABEL_WORDS) for template, fields in prompts]
+        probabilities = {}
+        if self.cache is not None:
+            for key in set(keys):
+                cached_probability = self.cache.get(key)
+                if cached_probability is not None:
+                    probabilities[key] = cached_probability
+
+        missing_examples = {}
+        for key, (template, fields) in zip(keys, prompts):
+            if key not in probabilities and key not in missing_examples:
+                missing_examples[key] = template.format(**fields)
+        if len(missing_examples) > 0:
+            outputs = self.score_labels_many(list(missing_examples.values()), max_batch_tokens, batch_size)
+            new_probabilities = list(zip(missing_examples, outputs))
+            probabilities.update(new_probabilities)
+            if self.cache is not None:
+                self.cache.set_many(new_probabilities)
+        return [probabilities[key] for key in keys]
+
+    def probability_to_answer(self, probability):
+        return {'rationale': "", 'answer_text': 'true' if probability >= 0.5 else 'false', 'probability': probability}
+
+    def answer_question_directly(self, question, evidence, claim_only = False):
         # answer question with FLAN-T5
         predict_answer = {}
-        answer_text = self.generate(example, 
+        answer_text = self.generate_from_prompts([self.question_prompt(question, evidence, claim_only)], 
                     max_length = None, 
-                    max_new_tokens = 32)[0].strip()
+                    max_new_tokens = 32)[0]
         
         predict_answer['rationale'] = ""
         predict_answer['answer_text'] = answer_text
         return predict_answer
 
     def answer_verify_question(self, claim, evidence, claim_only = False):
-        claim = claim[:-1] if claim.endswith('.') else claim
-        example = None
-        if claim_only == True:
-            example = f"Is it true that {claim}? True or false? The answer is: "
-        else:
-            example = f"{evidence}\nBased on the above information, is it true that {claim}? True or false? The answer is: "
+        if self.verify_scoring == 'logits':
+            probability = self.score_from_prompts([self.verify_prompt(claim, evidence, claim_only)])[0]
+            return self.probability_to_answer(probability)
 
         # answer question with FLAN-T5
         predict_answer = {}
-        answer_text = self.generate(example, 
+        answer_text = self.generate_from_prompts([self.verify_prompt(claim, evidence, claim_only)], 
                     max_length = None, 
-                    max_new_tokens = 8)[0].strip()
+                    max_new_tokens = 8)[0]
         
         predict_answer['rationale'] = ""
         predict_answer['answer_text'] = answer_text
         return predict_answer
 
+    # batched versions: FLAN-T5 calls of at most `batch_size` prompts and `max_batch_tokens` padded tokens
+    def batch_answer_question_directly(self, questions, evidences, claim_only = False, batch_size = 16, max_batch_tokens = 16384):
+        prompts = [self.question_prompt(question, evidence, claim_only) for question, evidence in zip(questions, evidences)]
+        answer_texts = self.generate_from_prompts(prompts, batch_size, max_batch_tokens, 
+                    max_length = None, 
+                    max_new_tokens = 32)
+        return [{'rationale': "", 'answer_text': answer_text} for answer_text in answer_texts]
 
+    def batch_answer_verify_question(self, claims, evidences, claim_only = False, batch_size = 16, max_batch_tokens = 16384):
+        prompts = [self.verify_prompt(claim, evidence, claim_only) for claim, evidence in zip(claims, evidences)]
+        if self.verify_scoring == 'logits':
+            probabilities = self.score_from_prompts(prompts, batch_size, max_batch_tokens)
+            return [self.probability_to_answer(probability) for probability in probabilities]
+        answer_texts = self.generate_from_prompts(prompts, batch_size, max_batch_tokens, 
+                    max_length = None, 
+                    max_new_tokens = 8)
+        return [{'rationale': "", 'answer_text': answer_text} for answer_text in answer_texts]
@@ -1,9 +1,10 @@
-from pyserini.search import LuceneSearcher
 from typing import Optional, List
 import logging
 import json
 from abc import ABCMeta, abstractmethod
 
+from cache import hash_key
+
 logger = logging.getLogger(__name__)
 
 class BaseRetriever(metaclass=ABCMeta):
@@ -54,8 +55,11 @@ class BaseRetriever(metaclass=ABCMeta):
         """
         pass
 
+def normalize_query(query: str):
+    return ' '.join(query.lower().split())
+
 class PyseriniRetriever(BaseRetriever):
-    def __init__(self, index_path: str, use_bm25: bool = True, k1: float = float(0.9), b: float = float(0.4)):
+    def __init__(self, index_path: str, use_bm25: bool = True, k1: float = float(0.9), b: float = float(0.4), cache = None):
         """
         Initialize Pyserini retriever
 
@@ -64,8 +68,13 @@ class PyseriniRetriever(BaseRetriever):
             use_bm25 (bool, optional): set BM25 as the scoring function. Defaults to True.
             k1 (float, optional): bm25 parameter to tune impact of term frequency Defaults to float(0.9).
             b (float, optional): bm25 constant to fine tune the effect of document length   Defaults to float(0.4).
+            cache (Persistent_Cache, optional): cache of hit lists keyed by the normalized query. Defaults to None.
         """
         self.index_path = index_path
+        self.cache = cache
+        self.search_config = {'index_path': index_path, 'use_bm25': use_bm25, 'k1': k1, 'b': b}
+        # pyserini starts a JVM when imported, so only the open-book setting pays for it
+        from pyserini.search import LuceneSearcher
         self.searcher = LuceneSearcher(index_path)
         self.searcher.set_bm25()
         if use_bm25:
@@ -97,8 +106,16 @@ class PyseriniRetriever(BaseRetriever):
 
         """
 
+        key = self._cache_key(query, top_k)
+        if self.cache is not None:
+            search_results = self.cache.get(key)
+            if search_results is not None:
+                return search_results
+
         hits = self.searcher.search(query, top_k)
         search_results = self._collect_hits(hits)
+        if self.cache is not None:
+            self.cache.set(key, search_results)
         return search_results
 
 
@@ -119,12 +136,36 @@ class PyseriniRetriever(BaseRetriever):
                 
         """
 
-        hits = self.searcher.batch_search(queries, qids, k=top_k, threads=threads)
         query_to_hits = {}
-        for q, hits in hits.items():
-            query_to_hits[q] = self._collect_hits(hits)
+        keys = [self._cache_key(query, top_k) for query in queries]
+        if self.cache is not None:
+            for qid, key in zip(qids, keys):
+                search_results = self.cache.get(key)
+                if search_results is not None:
+                    query_to_hits[qid] = search_results
+
+        # search each missing query once, even if it is repeated in the batch
+        missing = {}
+        for query, qid, key in zip(queries, qids, keys):
+            if qid not in query_to_hits and key not in missing:
+                missing[key] = (query, qid)
+        if len(missing) > 0:
+            missing_queries = [query for query, _ in missing.values()]
+            missing_qids = [qid for _, qid in missing.values()]
+            hits = self.searcher.batch_search(missing_queries, missing_qids, k=top_k, threads=threads)
+            key_to_hits = {}
+            for key, (_, qid) in missing.items():
+                key_to_hits[key] = self._collect_hits(hits[qid])
+            if self.cache is not None:
+                self.cache.set_many(list(key_to_hits.items()))
+            for qid, key in zip(qids, keys):
+                if qid not in query_to_hits:
+                    query_to_hits[qid] = key_to_hits[key]
         return query_to_hits
 
+    def _cache_key(self, query: str, top_k: int):
+        return hash_key(self.search_config, top_k, normalize_query(query))
+
 
     def _collect_hits(self, hits: List):
         search_results = []
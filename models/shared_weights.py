@@ -0,0 +1,90 @@
+import os
+import glob
+import json
+import mmap
+import struct
+import torch
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+def find_safetensors_files(model_name, cache_dir = None):
+    """The .safetensors files of a local model directory or of a Hugging Face hub model."""
+    if os.path.isdir(model_name):
+        model_dir = model_name
+    else:
+        from huggingface_hub import snapshot_download
+        model_dir = snapshot_download(model_name, cache_dir = cache_dir, allow_patterns = ['*.safetensors', '*.json'])
+    files = sorted(glob.glob(os.path.join(model_dir, '*.safetensors')))
+    if len(files) == 0:
+        raise Exception(f"No .safetensors weights for {model_name}; save the model with `save_pretrained(path, safe_serialization=True)` and pass the path")
+    return model_dir, files
+
+def mmap_safetensors(file_path):
+    """Tensors of a .safetensors file backed by a private mapping of the file.
+
+    The mapping is copy-on-write: pages are read from the page cache, so all
+    processes mapping the same file share one copy of the weights as long as
+    nobody writes to them.
+    """
+    with open(file_path, 'rb') as f:
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length))
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+    data_start = 8 + header_length
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        numel = 1
+        for size in info['shape']:
+            numel *= size
+        if numel == 0:
+            tensors[name] = torch.empty(info['shape'], dtype = dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype = dtype, count = numel, offset = data_start + start)
+        tensors[name] = tensor.view(info['shape'])
+    return tensors, buffer
+
+def set_module_tensor(model, name, tensor):
+    module_name, _, tensor_name = name.rpartition('.')
+    module = model.get_submodule(module_name) if module_name != '' else model
+    if tensor_name in module._parameters:
+        module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad = False)
+    else:
+        module._buffers[tensor_name] = tensor
+
+def load_mmap_model(model_class, model_name, cache_dir = None):
+    """Build `model_class` with its weights memory-mapped from the safetensors files, without copying them.
+
+    The model is created with empty weights on the meta device (no memory for
+    weights; accelerate's context manager also works on torch < 2.0), then each
+    parameter is replaced by a tensor viewing the mapped file. Processes
+    loading the same files, e.g. the workers of launch_shards.py, share the
+    weights and only add their own activations.
+    """
+    from transformers import AutoConfig
+    from accelerate import init_empty_weights
+    model_dir, files = find_safetensors_files(model_name, cache_dir)
+    config = AutoConfig.from_pretrained(model_dir)
+    with init_empty_weights():
+        model = model_class(config)
+
+    buffers = []
+    for file_path in files:
+        tensors, buffer = mmap_safetensors(file_path)
+        buffers.append(buffer)
+        for name, tensor in tensors.items():
+            set_module_tensor(model, name, tensor)
+    # embeddings shared by the encoder and the decoder are stored once
+    model.tie_weights()
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if len(missing) > 0:
+        raise Exception(f"Weights missing from the safetensors files of {model_name}: {missing[:5]}")
+    # the tensors view the mappings, which must live as long as the model
+    model._weight_mmaps = buffers
+    return model.eval()
@@ -1,8 +1,14 @@
 import backoff  # for exponential backoff
 import openai
 import os
+import time
+import random
 import asyncio
-from typing import Any
+import functools
+from collections import deque
+from typing import Any, Callable, Optional, Union
+
+from generation_backend import Program_Generation_Backend
 
 @backoff.on_exception(backoff.expo, openai.error.RateLimitError)
 def completions_with_backoff(**kwargs):
@@ -12,13 +18,120 @@ def completions_with_backoff(**kwargs):
 def chat_completions_with_backoff(**kwargs):
     return openai.ChatCompletion.create(**kwargs)
 
+def estimate_num_tokens(text: str) -> int:
+    """Rough token count of a prompt (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+class Request_Scheduler:
+    """Runs asynchronous API requests under concurrency and rate budgets.
+
+    At most `max_concurrency` requests are in flight at any time, and the 
+    requests started in the last minute stay within `requests_per_minute` 
+    and `tokens_per_minute` (when given). A failed request is retried on its 
+    own with exponential backoff (or after the server's Retry-After), so one 
+    failure neither stalls nor fails the other requests.
+    """
+    def __init__(self, 
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 6,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        fatal_exceptions: tuple = ()
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        # exceptions for which retrying is pointless, e.g. invalid requests
+        self.fatal_exceptions = fatal_exceptions
+        self.num_retries, self.num_failures = 0, 0
+
+    async def _acquire_budget(self, num_tokens: int):
+        """Wait until a request of `num_tokens` tokens fits in the per-minute budgets."""
+        async with self.budget_lock:
+            while True:
+                now = time.monotonic()
+                while len(self.started) > 0 and now - self.started[0][0] >= 60.0:
+                    self.started.popleft()
+                used_tokens = sum([tokens for _, tokens in self.started])
+                within_requests = self.requests_per_minute is None or len(self.started) < self.requests_per_minute
+                # a request larger than the whole budget runs alone
+                within_tokens = self.tokens_per_minute is None or len(self.started) == 0 \
+                                or used_tokens + num_tokens <= self.tokens_per_minute
+                if within_requests and within_tokens:
+                    self.started.append((now, num_tokens))
+                    return
+                await asyncio.sleep(max(0.05, 60.0 - (now - self.started[0][0])))
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        headers = getattr(error, 'headers', None) or {}
+        retry_after = headers.get('retry-after') or headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delay = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    async def _run_one(self, request_fn: Callable, num_tokens: int):
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                await self._acquire_budget(num_tokens)
+                try:
+                    return await request_fn()
+                except self.fatal_exceptions as e:
+                    print(f"Alert!!! request failed: {e}")
+                    break
+                except Exception as e:
+                    error = e
+            if attempt < self.max_retries:
+                self.num_retries += 1
+                await asyncio.sleep(self._retry_delay(attempt, error))
+            else:
+                print(f"Alert!!! request failed after {self.max_retries} retries: {error}")
+        self.num_failures += 1
+        return None
+
+    async def run(self, request_fns: list[Callable], token_counts: list[int], on_result: Optional[Callable] = None) -> list[Any]:
+        """Run all requests and return their responses in order (None for failed requests).
+
+        Args:
+            request_fns: coroutine functions without arguments, one per request.
+            token_counts: estimated number of tokens (prompt and completion) of each request.
+            on_result: called as on_result(index, response) as soon as a request is done.
+        """
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.budget_lock = asyncio.Lock()
+        self.started = deque()
+
+        async def run_indexed(index, request_fn, num_tokens):
+            return index, await self._run_one(request_fn, num_tokens)
+
+        tasks = [asyncio.ensure_future(run_indexed(index, request_fn, num_tokens)) 
+                 for index, (request_fn, num_tokens) in enumerate(zip(request_fns, token_counts))]
+        responses = [None] * len(tasks)
+        for future in asyncio.as_completed(tasks):
+            index, response = await future
+            responses[index] = response
+            if on_result is not None:
+                on_result(index, response)
+        return responses
+
 async def dispatch_openai_chat_requests(
     messages_list: list[list[dict[str,Any]]],
     model: str,
     temperature: float,
     max_tokens: int,
     top_p: float,
-    stop_words: list[str]
+    stop_words: list[str],
+    scheduler: Optional[Request_Scheduler] = None,
+    on_result: Optional[Callable] = None,
+    n: Union[int, list[int]] = 1
 ) -> list[str]:
     """Dispatches requests to OpenAI API asynchronously.
     
@@ -29,21 +142,29 @@ async def dispatch_openai_chat_requests(
         max_tokens: Maximum number of tokens to generate.
         top_p: Top p to use for the model.
         stop_words: List of words to stop the model from generating.
+        scheduler: Request_Scheduler keeping the requests within the rate limits.
+        on_result: Called as on_result(index, response) when a request is done.
+        n: Number of completions per request, for all requests or for each one.
     Returns:
-        List of responses from OpenAI API.
+        List of responses from OpenAI API (None for failed requests).
     """
-    async_responses = [
-        openai.ChatCompletion.acreate(
+    scheduler = scheduler if scheduler is not None else Request_Scheduler()
+    ns = n if isinstance(n, list) else [n] * len(messages_list)
+    request_fns = [
+        functools.partial(
+            openai.ChatCompletion.acreate,
             model=model,
             messages=x,
             temperature=temperature,
             max_tokens=max_tokens,
             top_p=top_p,
+            n = x_n,
             stop = stop_words
         )
-        for x in messages_list
+        for x, x_n in zip(messages_list, ns)
     ]
-    return await asyncio.gather(*async_responses)
+    token_counts = [sum([estimate_num_tokens(message['content']) for message in x]) + max_tokens * x_n for x, x_n in zip(messages_list, ns)]
+    return await scheduler.run(request_fns, token_counts, on_result)
 
 async def dispatch_openai_prompt_requests(
     messages_list: list[list[dict[str,Any]]],
@@ -51,29 +172,41 @@ async def dispatch_openai_prompt_requests(
     temperature: float,
     max_tokens: int,
     top_p: float,
-    stop_words: list[str]
+    stop_words: list[str],
+    scheduler: Optional[Request_Scheduler] = None,
+    on_result: Optional[Callable] = None,
+    n: Union[int, list[int]] = 1
 ) -> list[str]:
-    async_responses = [
-        openai.Completion.acreate(
+    scheduler = scheduler if scheduler is not None else Request_Scheduler()
+    ns = n if isinstance(n, list) else [n] * len(messages_list)
+    request_fns = [
+        functools.partial(
+            openai.Completion.acreate,
             model=model,
             prompt=x,
             temperature=temperature,
             max_tokens=max_tokens,
             top_p=top_p,
+            n = x_n,
             frequency_penalty = 0.0,
             presence_penalty = 0.0,
             stop = stop_words
         )
-        for x in messages_list
+        for x, x_n in zip(messages_list, ns)
     ]
-    return await asyncio.gather(*async_responses)
+    token_counts = [estimate_num_tokens(x) + max_tokens * x_n for x, x_n in zip(messages_list, ns)]
+    return await scheduler.run(request_fns, token_counts, on_result)
 
-class OpenAIModel:
-    def __init__(self, API_KEY, model_name, stop_words, max_new_tokens) -> None:
+# errors for which retrying a request is pointless
+FATAL_OPENAI_ERRORS = (openai.error.InvalidRequestError, openai.error.AuthenticationError)
+
+class OpenAIModel(Program_Generation_Backend):
+    def __init__(self, API_KEY, model_name, stop_words, max_new_tokens, api_base = None, scheduler = None, cache = None) -> None:
+        super().__init__(model_name, stop_words, max_new_tokens, cache)
         openai.api_key = API_KEY
-        self.model_name = model_name
-        self.max_new_tokens = max_new_tokens
-        self.stop_words = stop_words
+        if api_base is not None:
+            openai.api_base = api_base
+        self.scheduler = scheduler if scheduler is not None else Request_Scheduler(fatal_exceptions = FATAL_OPENAI_ERRORS)
 
     # used for chat-gpt and gpt-4
     def chat_generate(self, input_string, temperature = 0.0):
@@ -105,40 +238,59 @@ class OpenAIModel:
         generated_text = response['choices'][0]['text'].strip()
         return generated_text
 
-    def generate(self, input_string, temperature = 0.0):
+    def generate_uncached(self, input_string, temperature = 0.0):
         if self.model_name in ['text-davinci-002', 'code-davinci-002', 'text-davinci-003']:
             return self.prompt_generate(input_string, temperature)
         elif self.model_name in ['gpt-4', 'gpt-3.5-turbo']:
             return self.chat_generate(input_string, temperature)
         else:
             raise Exception("Model name not recognized")
-    
-    def batch_chat_generate(self, messages_list, temperature = 0.0):
+
+    # batched generation returns None for the requests that failed after all retries;
+    # on_result(index, generated_text) is called as soon as each request is done.
+    # With n > 1 (or a list of n per prompt), each result is the list of the n completions.
+    def batch_chat_generate(self, messages_list, temperature = 0.0, on_result = None, n = 1):
         open_ai_messages_list = []
         for message in messages_list:
             open_ai_messages_list.append(
                 [{"role": "user", "content": message}]
             )
+        multiple = isinstance(n, list) or n > 1
+        def parse(x):
+            if x is None:
+                return None
+            texts = [choice['message']['content'].strip() for choice in sorted(x['choices'], key=lambda choice: choice.get('index', 0))]
+            return texts if multiple else texts[0]
+        callback = (lambda index, x: on_result(index, parse(x))) if on_result is not None else None
         predictions = asyncio.run(
             dispatch_openai_chat_requests(
-                    open_ai_messages_list, self.model_name, temperature, self.max_new_tokens, 1.0, self.stop_words
+                    open_ai_messages_list, self.model_name, temperature, self.max_new_tokens, 1.0, self.stop_words,
+                    self.scheduler, callback, n
             )
         )
-        return [x['choices'][0]['message']['content'].strip() for x in predictions]
+        return [parse(x) for x in predictions]
     
-    def batch_prompt_generate(self, prompt_list, temperature = 0.0):
+    def batch_prompt_generate(self, prompt_list, temperature = 0.0, on_result = None, n = 1):
+        multiple = isinstance(n, list) or n > 1
+        def parse(x):
+            if x is None:
+                return None
+            texts = [choice['text'].strip() for choice in sorted(x['choices'], key=lambda choice: choice.get('index', 0))]
+            return texts if multiple else texts[0]
+        callback = (lambda index, x: on_result(index, parse(x))) if on_result is not None else None
         predictions = asyncio.run(
             dispatch_openai_prompt_requests(
-                    prompt_list, self.model_name, temperature, self.max_new_tokens, 1.0, self.stop_words
+                    prompt_list, self.model_name, temperature, self.max_new_tokens, 1.0, self.stop_words,
+                    self.scheduler, callback, n
             )
         )
-        return [x['choices'][0]['text'].strip() for x in predictions]
+        return [parse(x) for x in predictions]
 
-    def batch_generate(self, messages_list, temperature = 0.0):
+    def batch_generate_uncached(self, messages_list, temperature = 0.0, on_result = None, n = 1):
         if self.model_name in ['text-davinci-002', 'code-davinci-002', 'text-davinci-003']:
-            return self.batch_prompt_generate(messages_list, temperature)
+            return self.batch_prompt_generate(messages_list, temperature, on_result, n)
         elif self.model_name in ['gpt-4', 'gpt-3.5-turbo']:
-            return self.batch_chat_generate(messages_list, temperature)
+            return self.batch_chat_generate(messages_list, temperature, on_result, n)
         else:
             raise Exception("Model name not recognized")
 